@@ -1,14 +1,14 @@
 
 import os, io, tempfile, csv
 from datetime import datetime, timedelta
-from flask import Flask, request, abort, render_template, redirect, url_for, session, flash
+from flask import Flask, request, abort, render_template, redirect, url_for, session, flash, jsonify
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user, UserMixin
 from dotenv import load_dotenv
 from pydub import AudioSegment 
 
 load_dotenv()
 
-from services import db, schedule_service, notes_service, review_service, news_service, ocr_service
+from services import db, schedule_service, notes_service, review_service, news_service, ocr_service, ocr_jobs, upload_store
 db.init_db()
 
 from linebot import LineBotApi, WebhookHandler
@@ -16,6 +16,7 @@ from linebot.exceptions import InvalidSignatureError
 from linebot.models import MessageEvent, TextMessage, AudioMessage, TextSendMessage, ImageMessage
 
 app = Flask(__name__)
+db.init_app(app)
 
 app.secret_key = os.environ.get('FLASK_SECRET_KEY','dev-secret')
 login_manager = LoginManager(app)
@@ -43,8 +44,6 @@ PERIOD_MAP = {
     "12": ("19:30", "20:20"),
     "13": ("20:30", "21:20"),
 }
-USER_STATES = {}
-USER_IMG_BUFFER = {}
 
 class WebUser(UserMixin):
     def __init__(self, row):
@@ -89,8 +88,31 @@ def _active_user_id():
     return request.args.get("user") or "DEMO_USER"
 
 from tasks import start_scheduler
-if line_bot_api:
-    start_scheduler(line_bot_api)
+# 沒有 LINE 憑證時只跑不需要推播的背景工作（例如補摘要）
+start_scheduler(line_bot_api)
+
+def _push_note_summary(user_id, note):
+    """背景摘要完成後推播到 LINE（網站帳號 WEB_<id> 沒有 LINE 可推）。"""
+    if not line_bot_api or str(user_id).startswith("WEB_"):
+        return
+    text = f"筆記的 AI 重點整理好了：\n{note['summary']}"
+    line_bot_api.push_message(user_id, TextSendMessage(text=text[:4000]))
+
+from services import summary_worker
+summary_worker.set_notifier(_push_note_summary)
+
+def _push_review(user_id, period, course_name=None):
+    pack = review_service.generate_review(user_id, period, course_name=course_name)
+    text = pack[:4000] if pack else "這段期間沒有筆記，或 AI 產生失敗。"
+    line_bot_api.push_message(user_id, TextSendMessage(text=text))
+
+def _push_ocr_result(job):
+    """背景課表辨識結束後把結果推播到 LINE；網站上傳的由頁面輪詢。"""
+    if not line_bot_api or job["source"] != "line":
+        return
+    line_bot_api.push_message(job["user_id"], TextSendMessage(text=ocr_jobs.format_result(job)[:4000]))
+
+ocr_jobs.set_notifier(_push_ocr_result)
 
 def _get_target_lang(user_id: str) -> str:
     settings = db.get_user_settings(user_id) or {}
@@ -157,6 +179,26 @@ def debug_whoami():
     uid = _active_user_id()
     return f"active_user_id = {uid}  (已連結LINE={bool(getattr(current_user,'line_user_id',None))})"
 
+@app.route("/debug/metrics")
+@login_required
+def debug_metrics():
+    """目前 worker 行程的執行期統計（DB 連線數等）。"""
+    from services import feed_service, llm_client, summarize_service
+    return jsonify({
+        "pid": os.getpid(),
+        "db": db.connection_stats(),
+        "schema": db.applied_migrations(),
+        "news_crawl": news_service.last_cycle_stats,
+        "feed_cache": feed_service.cache_stats(),
+        "summary_cache": summarize_service.cache_stats(),
+        "summary_queue": summary_worker.stats(),
+        "review_cache": review_service.cache_stats(),
+        "review_queue": review_service.pool.stats(),
+        "llm": llm_client.stats(),
+        "ocr_cache": ocr_service.cache_stats(),
+        "ocr_jobs": ocr_jobs.stats(),
+    })
+
 @app.route("/account/link-line", methods=["GET","POST"])
 @login_required
 def link_line():
@@ -236,7 +278,6 @@ def web_schedule():
 
 @app.route("/web/notes")
 def web_notes():
-    notes_service.ensure_summaries(_current_user(), limit=30)
     conn = db.get_conn()
     notes = conn.execute("SELECT * FROM notes WHERE user_id=? ORDER BY ts DESC", (_current_user(),)).fetchall()
     conn.close()
@@ -245,8 +286,6 @@ def web_notes():
 @app.route("/web/notes/<int:note_id>")
 def web_note_detail(note_id):
     user_id = _current_user()
-    # 若該筆缺摘要，嘗試補一次（用 Gemini 或 fallback）
-    notes_service.ensure_summaries(user_id, limit=500)
     note = notes_service.get_note(user_id, note_id)
     if not note:
         return "筆記不存在或無權限查看", 404
@@ -256,8 +295,8 @@ def web_note_detail(note_id):
 @app.route("/web/notes/<int:note_id>/regen", methods=["POST"])
 def web_note_regen(note_id):
     user_id = _current_user()
-    # 用當天回顧包當作單筆摘要，與 /review today 對齊
-    today_pack = review_service.generate_review_for_date(user_id, datetime.now())
+    # 用當天回顧包當作單筆摘要，與 /review today 對齊；regen 要略過快取重新產生
+    today_pack = review_service.generate_review_for_date(user_id, datetime.now(), refresh=True)
     updated = notes_service.regenerate_note_summary(user_id, note_id, new_summary=today_pack)
     if not updated:
         return "筆記不存在或無權限操作", 404
@@ -302,7 +341,6 @@ def web_settings():
 @app.route("/web/notes/manage")
 def web_notes_page():
     user_id = _current_user()
-    notes_service.ensure_summaries(user_id, limit=50)
     notes = notes_service.list_notes(user_id)
     return render_template("web_notes.html", user_id=user_id, notes=notes)
 
@@ -319,7 +357,19 @@ def web_notes_add():
 def web_news_page():
     user_id = _current_user()
     q = request.args.get("q", "").strip()
-    results = news_service.search_news(user_id, q, limit_per_feed=10) if q else []
+    since = (request.args.get("since") or "").strip() or None
+    until = (request.args.get("until") or "").strip() or None
+    try:
+        page = max(1, int(request.args.get("page") or 1))
+    except ValueError:
+        page = 1
+    per_page = 20
+    results, total = [], 0
+    if q:
+        try:
+            results, total = news_service.search_news(user_id, q, page=page, per_page=per_page, since=since, until=until)
+        except ValueError:
+            flash("日期格式錯誤，請使用 YYYY-MM-DD", "error")
 
     refreshed = None
     if (request.args.get("refreshed") or "").strip() == "1":
@@ -337,6 +387,11 @@ def web_news_page():
         feeds=news_service.list_feeds(user_id),
         query=q,
         results=results,
+        total=total,
+        page=page,
+        pages=(total + per_page - 1) // per_page,
+        since=since or "",
+        until=until or "",
         refreshed=refreshed,
     )
 
@@ -349,9 +404,9 @@ def web_news_refresh():
         refreshed = []
     else:
         feeds = news_service.get_feeds_for_user(user_id)
-        refreshed = news_service.crawl_and_filter(kws, feeds=feeds)
+        refreshed = news_service.crawl_and_filter(kws, feeds=feeds, user_id=user_id)
+        news_service.record_sent([(user_id, title, url) for title, url in refreshed])
         for title, url in refreshed:
-            news_service.record_sent(url, title)
             # 同步推送到 LINE（若已設定 token）
             if line_bot_api:
                 try:
@@ -400,23 +455,40 @@ def web_feed_remove():
 def web_review_page():
     user_id = _current_user()
     pack = None
+    period = request.form.get("period") or "today"
+    course_name = (request.form.get("course_name") or "").strip() or None
     if request.method == "POST":
-        pack = review_service.generate_review_for_date(user_id, datetime.now())
-    return render_template("review.html", user_id=user_id, pack=pack)
+        pack = review_service.generate_review(user_id, period, course_name=course_name)
+    return render_template("review.html", user_id=user_id, pack=pack, period=period, course_name=course_name or "")
 
 @app.route("/web/schedule/manage")
 def web_schedule_manage():
     user_id = _current_user()
     schedule = schedule_service.get_indexed_schedule(user_id)
     schedule.sort(key=lambda x: (x['day_of_week'], x['start_time']))
+    ocr_job = None
+    job_id = request.args.get("ocr_job", type=int)
+    if job_id:
+        ocr_job = ocr_jobs.get_job(user_id, job_id)
+        if ocr_job:
+            ocr_job["message"] = ocr_jobs.format_result(ocr_job)
     return render_template("schedule_manage.html",
         schedule=schedule,
         user_id=user_id,
         form_data={},
         error_msg=None,
-        error_field=None
+        error_field=None,
+        ocr_job=ocr_job
     )
 
+@app.route("/web/schedule/ocr-jobs/<int:job_id>")
+def web_schedule_ocr_job(job_id):
+    """課表圖片辨識工作的狀態（給 schedule_manage 頁面輪詢）。"""
+    job = ocr_jobs.get_job(_current_user(), job_id)
+    if not job:
+        return jsonify({"error": "not found"}), 404
+    return jsonify({"id": job["id"], "status": job["status"], "message": ocr_jobs.format_result(job)})
+
 @app.route("/web/schedule/add", methods=["POST"])
 def web_schedule_add():
     user_id = request.form.get("user") or "DEMO_USER"
@@ -455,23 +527,15 @@ def web_schedule_upload():
     user_id = _current_user()
     f = request.files.get("csv")
     if f:
-        reader = csv.DictReader(io.StringIO(f.stream.read().decode("utf-8")))
-        success = 0
-        fails = []
-        for row in reader:
-            try:
-                target_user = row.get("user_id") or user_id
-                schedule_service.add_course(
-                    user_id=target_user,
-                    course_name=row.get("course_name"),
-                    dow=int(row.get("day_of_week")),
-                    start_time=row.get("start_time"),
-                    end_time=row.get("end_time"),
-                    location=row.get("location"),
-                )
-                success += 1
-            except Exception as e:
-                fails.append(str(e))
+        # 邊讀邊解碼，不把整個檔案讀成字串；整批一次檢查衝堂、一個 transaction 寫入
+        reader = csv.DictReader(io.TextIOWrapper(f.stream, encoding="utf-8-sig", newline=""))
+        try:
+            results = schedule_service.add_courses(user_id, reader)
+        except UnicodeDecodeError:
+            flash("CSV 需為 UTF-8 編碼", "error")
+            return redirect(url_for("web_schedule_manage", user=user_id))
+        success = sum(1 for r in results if r["ok"])
+        fails = [f"{r['course_name']}: {r['error']}" for r in results if not r["ok"]]
         if success:
             flash(f"已成功匯入 {success} 筆課程", "success")
         if fails:
@@ -497,40 +561,15 @@ def web_schedule_upload_images():
         return redirect(url_for("web_schedule_manage", user=user_id))
 
     try:
-        courses = ocr_service.parse_schedule_from_images(image_bytes_list)
-        if not courses:
-            flash("AI 未能辨識出任何課程，請確認圖片清晰度或格式。", "error")
-            return redirect(url_for("web_schedule_manage", user=user_id))
-
-        success_count = 0
-        fail_msg = []
-        for c in courses:
-            try:
-                if not c.get("course_name") or not c.get("start_time"):
-                    continue
-                schedule_service.add_course(
-                    user_id,
-                    course_name=c["course_name"],
-                    dow=int(c["day_of_week"]),
-                    start_time=c["start_time"],
-                    end_time=c["end_time"],
-                    location=c.get("location"),
-                )
-                success_count += 1
-            except ValueError as ve:
-                fail_msg.append(f"• {c.get('course_name')}: {str(ve)}")
-            except Exception:
-                continue
-
-        if success_count > 0:
-            flash(f"🎉 成功匯入 {success_count} 堂課程！", "success")
-        if fail_msg:
-            flash("部分失敗：" + " ".join(fail_msg[:3]), "error")
+        # 辨識交給背景工作，頁面帶著 job id 回來輪詢結果
+        job_id = ocr_jobs.submit(user_id, images=image_bytes_list,
+                                 refresh=bool(request.form.get("refresh")), source="web")
     except Exception as e:
         print(f"Web OCR Error: {e}")
         flash(f"系統發生錯誤: {e}", "error")
+        return redirect(url_for("web_schedule_manage", user=user_id))
 
-    return redirect(url_for("web_schedule_manage", user=user_id))
+    return redirect(url_for("web_schedule_manage", user=user_id, ocr_job=job_id))
 
 @app.route("/web/schedule/delete", methods=["POST"])
 def web_schedule_delete():
@@ -562,47 +601,24 @@ def handle_text_message(event: MessageEvent):
     text = (event.message.text or "").strip()
     db.ensure_user(user_id)
 
-    if USER_STATES.get(user_id) == "WAIT_SCHEDULE_IMG":
-        if text.lower() in ["完成", "done", "ok", "沒有", "沒有了", "結束", "no"]:
-            images = USER_IMG_BUFFER.get(user_id, [])
-            if not images:
+    if upload_store.get_state(user_id) == upload_store.SCHEDULE_IMAGES:
+        refresh = text.lower() in ["重新辨識", "refresh"]
+        if refresh or text.lower() in ["完成", "done", "ok", "沒有", "沒有了", "結束", "no"]:
+            # 圖片可能是另一個 worker 收的；檔案直接交給背景辨識工作，先回覆再推播結果
+            paths = upload_store.take_images(user_id)
+            if not paths:
+                upload_store.start_session(user_id, upload_store.SCHEDULE_IMAGES)
                 line_bot_api.reply_message(event.reply_token, TextSendMessage(text="您還沒有上傳任何圖片！請傳送圖片。"))
                 return
 
-            print(f"使用者 {user_id} 輸入完成，開始辨識 {len(images)} 張圖片...")
-            courses = ocr_service.parse_schedule_from_images(images)
-
-            success_count = 0
-            fail_msg = []
-            for c in courses:
-                try:
-                    if not c.get('course_name') or not c.get('start_time'):
-                        continue
-                    schedule_service.add_course(
-                        user_id,
-                        c['course_name'],
-                        int(c['day_of_week']),
-                        c['start_time'],
-                        c['end_time'],
-                        c.get('location')
-                    )
-                    success_count += 1
-                except ValueError as ve:
-                    fail_msg.append(f"• {c['course_name']}: {str(ve)}")
-                except Exception:
-                    continue
-
-            USER_STATES.pop(user_id, None)
-            USER_IMG_BUFFER.pop(user_id, None)
-
-            reply = f"辨識完成！共加入 {success_count} 堂課程。"
-            if fail_msg:
-                reply += "\n部分失敗：\n" + "\n".join(fail_msg[:3])
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply))
+            print(f"使用者 {user_id} 輸入完成，排入辨識 {len(paths)} 張圖片...")
+            ocr_jobs.submit(user_id, paths=paths, refresh=refresh, source="line")
+            line_bot_api.reply_message(event.reply_token, TextSendMessage(
+                text=f"收到 {len(paths)} 張圖片，開始辨識課表，完成後會傳結果給你。"))
             return
 
         if not text.startswith("/"):
-            count = len(USER_IMG_BUFFER.get(user_id, []))
+            count = upload_store.image_count(user_id)
             line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"已收集 {count} 張。請繼續傳下一張，傳完請輸入「完成」。"))
             return
 
@@ -782,8 +798,7 @@ def handle_text_message(event: MessageEvent):
         if text == "/schedule upload image":
             if schedule_service.list_schedule(user_id):
                 line_bot_api.reply_message(event.reply_token, TextSendMessage(text="課表已有資料，請先清空。"))
-            USER_STATES[user_id] = "WAIT_SCHEDULE_IMG"
-            USER_IMG_BUFFER[user_id] = []
+            upload_store.start_session(user_id, upload_store.SCHEDULE_IMAGES)
             line_bot_api.reply_message(
                 event.reply_token,
                 TextSendMessage(text="請依序傳送課表圖片\n\n全部傳完後，請輸入「完成」")
@@ -867,22 +882,30 @@ def handle_text_message(event: MessageEvent):
             line_bot_api.reply_message(event.reply_token, TextSendMessage(text="請在 /note 後面接上筆記內容。"))
             return
 
-        summary = notes_service.add_note(user_id, content, course_name=None)
-        msg = "已新增筆記。"
+        # 短筆記的重點當場產生、直接放進回覆；要走 LLM 的先回覆，完成後再推播
+        _, summary = notes_service.add_note(user_id, content, course_name=None, notify=True)
         if summary:
-            msg += "\nAI 重點：\n" + summary
+            msg = "已新增筆記。\nAI 重點：\n" + summary
+        else:
+            msg = "已新增筆記，AI 重點產生中，完成後會再傳給你。"
         msg += f"\n\n在網頁管理：{web_notes_url}"
         line_bot_api.reply_message(event.reply_token, TextSendMessage(text=msg))
         return
 
     if text.startswith("/review"):
-        tokens = text.split()
-        when = tokens[1] if len(tokens) > 1 else "today"
-        if when != "today":
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="目前僅支援 `/review today`"))
+        tokens = text.split(maxsplit=2)
+        when = tokens[1].lower() if len(tokens) > 1 else "today"
+        course_name = tokens[2].strip() if len(tokens) > 2 else None
+        if when not in ("today", "week", "month", "course") or (when == "course" and not course_name):
+            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="用法：/review today|week|month 或 /review course <課名>"))
             return
-        pack = review_service.generate_review_for_date(user_id, datetime.now())
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=(pack[:4000] if pack else "今天沒有筆記，或 AI 產生失敗。")))
+        if when == "today":
+            pack = review_service.generate_review_for_date(user_id, datetime.now())
+            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=(pack[:4000] if pack else "今天沒有筆記，或 AI 產生失敗。")))
+            return
+        # 跨多天的回顧包可能要數次 LLM 呼叫，先回覆再背景產生後推播
+        review_service.pool.submit(_push_review, user_id, when, course_name)
+        line_bot_api.reply_message(event.reply_token, TextSendMessage(text="回顧包產生中，完成後會傳給你。"))
         return
 
     if text.startswith("/news feed "):
@@ -940,15 +963,14 @@ def handle_text_message(event: MessageEvent):
                 line_bot_api.reply_message(event.reply_token, TextSendMessage(text="尚未設定關鍵字，可先用 /news add <kw>。"))
                 return
             feeds = news_service.get_feeds_for_user(user_id)
-            hits = news_service.crawl_and_filter(kws, feeds=feeds)
+            hits = news_service.crawl_and_filter(kws, feeds=feeds, user_id=user_id)
             if not hits:
                 line_bot_api.reply_message(event.reply_token, TextSendMessage(text="目前沒有符合關鍵字的最新新聞。"))
             else:
                 web_url = (os.environ.get("HOST_BASE_URL") or "http://localhost:5000") + "/web/news?refreshed=1"
                 body = "【即時刷新】\n" + "\n".join([f"- {t}\n  {u}" for t, u in hits[:5]])
                 body += f"\n\n在網頁查看完整列表：{web_url}"
-                for title, url in hits:
-                    news_service.record_sent(url, title)
+                news_service.record_sent([(user_id, title, url) for title, url in hits])
                 line_bot_api.reply_message(event.reply_token, TextSendMessage(text=body[:4000]))
         elif sub == "list":
             kws = news_service.list_keywords(user_id)
@@ -1031,7 +1053,7 @@ def handle_image_message(event):
     user_id = event.source.user_id
     db.ensure_user(user_id)
 
-    if USER_STATES.get(user_id) != "WAIT_SCHEDULE_IMG":
+    if upload_store.get_state(user_id) != upload_store.SCHEDULE_IMAGES:
         line_bot_api.reply_message(
             event.reply_token,
             TextSendMessage(text="若要上傳課表，請先輸入指令：\n/schedule upload image")
@@ -1040,14 +1062,12 @@ def handle_image_message(event):
 
     try:
         message_content = line_bot_api.get_message_content(event.message.id)
-        image_bytes = b""
-        for chunk in message_content.iter_content():
-            image_bytes += chunk
-
-        USER_IMG_BUFFER.setdefault(user_id, []).append(image_bytes)
-        count = len(USER_IMG_BUFFER[user_id])
+        # 邊下載邊寫進 spool 檔，不在記憶體裡累積整張圖
+        count = upload_store.save_image(user_id, message_content.iter_content())
         print(f"[Silent] 已收到使用者 {user_id} 的第 {count} 張圖片")
 
+    except upload_store.UploadLimitError as e:
+        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=str(e)))
     except Exception as e:
         print(f"Image Receive Error: {e}")
         line_bot_api.reply_message(
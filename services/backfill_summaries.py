@@ -2,20 +2,174 @@
 
 Usage:
     python -m services.backfill_summaries
+    python -m services.backfill_summaries --workers 4 --batch-size 20 --rate 2
+    python -m services.backfill_summaries --dry-run
     # 或直接
     python services/backfill_summaries.py
+
+依 note id 由小到大分批處理缺摘要的筆記：每批一次 summarize_notes（可能合併成一次 LLM 呼叫），
+由 worker pool 並行產生、主執行緒以單一 transaction 寫回。進度（已連續完成的最大 id）
+存在 checkpoint 檔，中斷後重跑會從那裡接著做；--reset 從頭開始。
 """
-import sys, pathlib
+import argparse, json, os, sys, pathlib, time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 # allow running as script
 if __package__ is None:
     sys.path.append(str(pathlib.Path(__file__).resolve().parent.parent))
 
-from services.notes_service import ensure_summaries_for_all  # type: ignore
+from services import db  # type: ignore
+from services.llm_client import TokenBucket  # type: ignore
+from services.notes_service import _mark_reviews_stale, claim_for_summary  # type: ignore
+from services.summarize_service import needs_llm, summarize_notes  # type: ignore
+
+_MISSING = "(summary IS NULL OR summary='')"
+
+
+def _load_checkpoint(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return int(json.load(f).get("last_id", 0))
+    except (OSError, ValueError):
+        return 0
+
+
+def _save_checkpoint(path, last_id, done):
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"last_id": last_id, "done": done, "updated_at": time.time()}, f)
+    os.replace(tmp, path)
+
+
+def _count_pending(after_id, user_id=None):
+    sql = f"SELECT COUNT(*) FROM notes WHERE id > ? AND {_MISSING}"
+    params = [after_id]
+    if user_id:
+        sql += " AND user_id=?"
+        params.append(user_id)
+    conn = db.get_conn()
+    n = conn.execute(sql, params).fetchone()[0]
+    conn.close()
+    return n
+
+
+def _batches(after_id, batch_size, limit=None, user_id=None):
+    """以 keyset 分頁逐批讀出缺摘要的筆記（不會一次載入全部）。"""
+    sent = 0
+    while limit is None or sent < limit:
+        size = batch_size if limit is None else min(batch_size, limit - sent)
+        sql = f"SELECT id, content, user_id FROM notes WHERE id > ? AND {_MISSING}"
+        params = [after_id]
+        if user_id:
+            sql += " AND user_id=?"
+            params.append(user_id)
+        conn = db.get_conn()
+        rows = conn.execute(sql + " ORDER BY id LIMIT ?", params + [size]).fetchall()
+        conn.close()
+        if not rows:
+            return
+        yield [(r["id"], r["content"], r["user_id"]) for r in rows]
+        sent += len(rows)
+        after_id = rows[-1]["id"]
+
+
+@db.background_job
+def _summarize(batch):
+    # 只做搶到的筆記；summary_worker 或排程 backfill 正在做的留給它們
+    claimed = set(claim_for_summary(note_id for note_id, _, _ in batch))
+    mine = [item for item in batch if item[0] in claimed]
+    return batch, mine, summarize_notes([content for _, content, _ in mine])
+
+
+def _write(batch, summaries):
+    updates = [(s, "done" if s else "failed", note_id) for (note_id, _, _), s in zip(batch, summaries)]
+    conn = db.get_conn()
+    with conn:
+        conn.executemany("UPDATE notes SET summary=?, summary_status=? WHERE id=?", updates)
+        _mark_reviews_stale(conn, *(user_id for (_, _, user_id), s in zip(batch, summaries) if s))
+    conn.close()
+    return sum(1 for s, _, _ in updates if s)
+
+
+def _fmt_eta(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600:d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--workers", type=int, default=4, help="並行產生摘要的 worker 數")
+    ap.add_argument("--batch-size", type=int, default=20, help="每批筆記數（一批一個 transaction）")
+    ap.add_argument("--rate", type=float, default=0.0, help="每秒最多處理幾則筆記（0 = 不限；LLM 另有 LLM_RPM）")
+    ap.add_argument("--limit", type=int, default=None, help="這次最多處理幾則")
+    ap.add_argument("--user", default=None, help="只處理某位使用者")
+    ap.add_argument("--checkpoint", default=None, help="進度檔路徑（預設 <DB_PATH>.backfill.json）")
+    ap.add_argument("--reset", action="store_true", help="忽略既有進度，從頭開始")
+    ap.add_argument("--dry-run", action="store_true", help="只統計要處理的筆記，不呼叫 LLM、不寫入")
+    args = ap.parse_args(argv)
+
+    db.init_db()
+    checkpoint = args.checkpoint or f"{db.DB_PATH}.backfill.json"
+    start_id = 0 if args.reset else _load_checkpoint(checkpoint)
+    total = _count_pending(start_id, args.user)
+    if args.limit is not None:
+        total = min(total, args.limit)
+    print(f"Backfill: {total} notes without summary (id > {start_id}), checkpoint {checkpoint}")
+
+    if args.dry_run:
+        llm = 0
+        for batch in _batches(start_id, args.batch_size, args.limit, args.user):
+            llm += sum(1 for _, content, _ in batch if needs_llm(content))
+        print(f"Dry run: {llm} would go to the LLM, {total - llm} to the extractive summarizer. Nothing written.")
+        return
+
+    bucket = TokenBucket(args.rate, max(1, args.batch_size)) if args.rate > 0 else None
+    started = time.perf_counter()
+    done = updated = 0
+    # 已送出但還沒寫回的批次：依起始順序記錄，只有最前面連續完成的才推進 checkpoint
+    inflight_order = []
+    finished = {}
+    watermark = start_id
+    with ThreadPoolExecutor(max_workers=max(1, args.workers), thread_name_prefix="backfill") as ex:
+        pending = set()
+
+        def drain():
+            nonlocal done, updated, watermark
+            if not pending:
+                return
+            ready, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in ready:
+                pending.discard(fut)
+                batch, mine, summaries = fut.result()
+                updated += _write(mine, summaries)
+                done += len(batch)
+                finished[batch[0][0]] = batch[-1][0]
+            advanced = False
+            while inflight_order and inflight_order[0] in finished:
+                watermark = finished.pop(inflight_order.pop(0))
+                advanced = True
+            if advanced:
+                _save_checkpoint(checkpoint, watermark, done)
+            elapsed = time.perf_counter() - started
+            rate = done / elapsed if elapsed else 0.0
+            eta = _fmt_eta((total - done) / rate) if rate else "?"
+            print(f"  {done}/{total} notes, {updated} updated, {rate:.1f} notes/s, ETA {eta}")
+
+        for batch in _batches(start_id, args.batch_size, args.limit, args.user):
+            if bucket:
+                for _ in batch:
+                    bucket.acquire()
+            while len(pending) >= args.workers * 2:
+                drain()
+            inflight_order.append(batch[0][0])
+            pending.add(ex.submit(_summarize, batch))
+        while pending:
+            drain()
+
+    elapsed = time.perf_counter() - started
+    print(f"Backfill done. Updated {updated} of {done} notes in {elapsed:.1f}s "
+          f"({done / elapsed if elapsed else 0:.1f} notes/s). Resume point: id {watermark}")
 
-def main():
-    updated = ensure_summaries_for_all(limit_per_user=500)
-    print(f"Backfill done. Updated {updated} summaries.")
 
 if __name__ == "__main__":
     main()
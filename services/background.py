@@ -0,0 +1,73 @@
+"""In-process background worker pools with queue metrics.
+
+每個 gunicorn worker 各自有自己的 pool（fork 後會重建）；工作內容要能重跑，
+因為行程重啟時還沒做完的工作只能靠資料庫裡的狀態再撿起來。
+"""
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from . import db
+
+
+class BackgroundPool:
+    def __init__(self, name, max_workers):
+        self.name = name
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+        self._stats = {"submitted": 0, "started": 0, "completed": 0, "failed": 0,
+                       "wait_ms_total": 0.0, "run_ms_total": 0.0, "latency_ms_max": 0.0}
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                    thread_name_prefix=self.name)
+                self._pid = os.getpid()
+            return self._executor
+
+    def submit(self, fn, *args, **kwargs):
+        enqueued = time.perf_counter()
+
+        def run():
+            started = time.perf_counter()
+            with self._lock:
+                self._stats["started"] += 1
+                self._stats["wait_ms_total"] += (started - enqueued) * 1000.0
+            ok = False
+            try:
+                result = fn(*args, **kwargs)
+                ok = True
+                return result
+            except Exception as e:
+                print(f"[{self.name}] job failed: {e!r}")
+                raise
+            finally:
+                # 工作中途丟例外、沒走到 close() 的連線也要還回去，不能讓寫入 transaction 留在 thread 上
+                db.release_thread_conn()
+                done = time.perf_counter()
+                with self._lock:
+                    self._stats["completed" if ok else "failed"] += 1
+                    self._stats["run_ms_total"] += (done - started) * 1000.0
+                    self._stats["latency_ms_max"] = max(self._stats["latency_ms_max"],
+                                                        (done - enqueued) * 1000.0)
+
+        executor = self._get_executor()
+        with self._lock:
+            self._stats["submitted"] += 1
+        return executor.submit(run)
+
+    def stats(self):
+        with self._lock:
+            out = dict(self._stats)
+        finished = out["completed"] + out["failed"]
+        out["queue_depth"] = out["submitted"] - out["started"]
+        out["running"] = out["started"] - finished
+        out["wait_ms_avg"] = round(out.pop("wait_ms_total") / out["started"], 1) if out["started"] else 0.0
+        out["run_ms_avg"] = round(out.pop("run_ms_total") / finished, 1) if finished else 0.0
+        out["latency_ms_max"] = round(out["latency_ms_max"], 1)
+        out["max_workers"] = self.max_workers
+        return out
@@ -0,0 +1,110 @@
+"""Offline throughput benchmark for the note / review pipelines on the stub LLM provider.
+
+Usage:
+    python -m services.bench_llm
+    python -m services.bench_llm --notes 500 --users 50 --latency-ms 800 --failure-rate 0.05 --rpm 600
+
+強制 LLM_PROVIDER=stub（不會花到 Gemini 額度），在暫存目錄建立獨立的 SQLite。
+"""
+import argparse, os, sys, pathlib, tempfile, time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+# allow running as script
+if __package__ is None:
+    sys.path.append(str(pathlib.Path(__file__).resolve().parent.parent))
+
+
+def _pct(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def _wait_idle(pool, timeout=600):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        s = pool.stats()
+        if s["completed"] + s["failed"] >= s["submitted"]:
+            return
+        time.sleep(0.05)
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--notes", type=int, default=200, help="每個情境的筆記數")
+    ap.add_argument("--users", type=int, default=20)
+    ap.add_argument("--latency-ms", type=float, default=300.0, help="stub 每次呼叫的平均延遲")
+    ap.add_argument("--jitter-ms", type=float, default=50.0)
+    ap.add_argument("--failure-rate", type=float, default=0.0, help="stub 注入暫時性錯誤的機率")
+    ap.add_argument("--rpm", type=float, default=6000.0, help="LLM_RPM")
+    ap.add_argument("--concurrency", type=int, default=8, help="LLM_CONCURRENCY")
+    ap.add_argument("--workers", type=int, default=4, help="SUMMARY_WORKERS")
+    args = ap.parse_args(argv)
+
+    os.environ.update({
+        "LLM_PROVIDER": "stub",
+        "LLM_STUB_LATENCY_MS": str(args.latency_ms),
+        "LLM_STUB_JITTER_MS": str(args.jitter_ms),
+        "LLM_STUB_FAILURE_RATE": str(args.failure_rate),
+        "LLM_STUB_SEED": "42",
+        "LLM_RPM": str(args.rpm),
+        "LLM_BURST": str(args.concurrency),
+        "LLM_CONCURRENCY": str(args.concurrency),
+        "LLM_BACKOFF_BASE": "0.05",
+        "SUMMARY_WORKERS": str(args.workers),
+        # bench 的筆記都很短，不關掉門檻的話全部走 extractive，量不到 LLM 路徑
+        "SUMMARY_LLM_MIN_CHARS": "0",
+    })
+    from services import db, llm_client, notes_service, review_service, summary_worker  # type: ignore
+
+    users = [f"U{i:05d}" for i in range(args.users)]
+    with tempfile.TemporaryDirectory() as tmp:
+        db.close_pool()
+        db.DB_PATH = os.path.join(tmp, "bench.sqlite3")
+        db.init_db()
+
+        # 1) /note：回覆延遲（只含存檔）與背景摘要完成的吞吐量
+        reply_ms = []
+        t0 = time.perf_counter()
+        for i in range(args.notes):
+            t = time.perf_counter()
+            notes_service.add_note(users[i % len(users)], f"第 {i} 則筆記\n作業系統 deadlock 預防 {i}\n銀行家演算法")
+            reply_ms.append((time.perf_counter() - t) * 1000.0)
+        _wait_idle(summary_worker.pool)
+        note_s = time.perf_counter() - t0
+        print(f"note pipeline : {args.notes} notes in {note_s:.2f}s ({args.notes / note_s:.1f}/s), "
+              f"reply p50 {_pct(reply_ms, 0.5):.1f} ms p95 {_pct(reply_ms, 0.95):.1f} ms")
+
+        # 2) 批次 backfill：同樣數量的 pending 筆記
+        conn = db.get_conn()
+        conn.executemany(
+            "INSERT INTO notes(user_id, ts, content, summary_status) VALUES (?,?,?,'pending')",
+            ((users[i % len(users)], "2024-01-01T09:00:00", f"舊筆記 {i}\n排程演算法 {i}") for i in range(args.notes)),
+        )
+        conn.commit()
+        conn.close()
+        t0 = time.perf_counter()
+        done = notes_service.backfill_pending(budget=args.notes)
+        backfill_s = time.perf_counter() - t0
+        print(f"batch backfill: {done} notes in {backfill_s:.2f}s ({done / backfill_s:.1f}/s)")
+
+        # 3) 回顧包：所有使用者同時要今天的回顧包，第二輪應全部命中快取
+        now = datetime.now()
+        for label in ("review cold", "review warm"):
+            t0 = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.concurrency) as ex:
+                packs = list(ex.map(lambda u: review_service.generate_review_for_date(u, now), users))
+            review_s = time.perf_counter() - t0
+            print(f"{label:<14}: {len(packs)} users in {review_s:.2f}s ({len(packs) / review_s:.1f}/s)")
+        db.close_pool()
+
+    s = llm_client.stats()
+    print(f"llm: calls {s['calls']} errors {s['errors']} retries {s['retries']} throttled {s['throttled']}")
+    for kind, k in sorted(s["by_kind"].items()):
+        print(f"  {kind:<20} calls {k['calls']:>5} avg {k['latency_ms_avg']:>7.1f} ms max {k['latency_ms_max']:>7.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
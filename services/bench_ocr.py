@@ -0,0 +1,125 @@
+"""Benchmark OCR image preparation: full-resolution stitching vs. the preprocessing pipeline.
+
+Usage:
+    python -m services.bench_ocr
+    python -m services.bench_ocr --shots 12 --uplink-mbps 10 --llm-ms 3000
+
+產生模擬的手機課表截圖（往下捲動、彼此重疊，含狀態列與底部導覽列），
+每種做法在獨立的子行程量 peak RSS、送給模型的 payload 大小與端到端延遲
+（前處理 + 以 --uplink-mbps 估算的上傳時間 + stub 模型延遲）。
+"""
+import argparse, io, json, os, resource, subprocess, sys, pathlib, tempfile, time
+
+# allow running as script
+if __package__ is None:
+    sys.path.append(str(pathlib.Path(__file__).resolve().parent.parent))
+
+from PIL import Image, ImageDraw  # type: ignore
+
+SHOT_W, SHOT_H, STATUS_H, NAV_H = 1170, 2532, 120, 180
+
+
+def _page(height):
+    """一整頁捲動式課表：表格格線 + 彩色課程格 + 文字。"""
+    page = Image.new("RGB", (SHOT_W, height), (250, 250, 250))
+    d = ImageDraw.Draw(page)
+    colors = [(255, 214, 165), (202, 255, 191), (155, 246, 255), (189, 178, 255), (255, 198, 255)]
+    row_h = 180
+    for r in range(height // row_h):
+        y = r * row_h
+        d.line([(0, y), (SHOT_W, y)], fill=(200, 200, 200), width=2)
+        d.text((20, y + 20), f"{8 + r % 13:02d}:10", fill=(80, 80, 80))
+        for c in range(5):
+            x = 150 + c * 200
+            if (r * 7 + c * 3) % 4 == 0:
+                d.rectangle([x + 6, y + 6, x + 194, y + row_h - 6], fill=colors[(r + c) % len(colors)])
+                d.text((x + 16, y + 30), f"Course {r}-{c}", fill=(20, 20, 20))
+                d.text((x + 16, y + 60), f"R{100 + r * 5 + c}", fill=(60, 60, 60))
+    return page
+
+
+def make_screenshots(n, overlap=0.3, quality=90):
+    visible = SHOT_H - STATUS_H - NAV_H
+    step = int(visible * (1 - overlap))
+    page = _page(visible + step * (n - 1))
+    shots = []
+    for i in range(n):
+        shot = Image.new("RGB", (SHOT_W, SHOT_H), (255, 255, 255))
+        ImageDraw.Draw(shot).rectangle([0, 0, SHOT_W, STATUS_H], fill=(30, 30, 30))
+        shot.paste(page.crop((0, i * step, SHOT_W, i * step + visible)), (0, STATUS_H))
+        ImageDraw.Draw(shot).rectangle([0, SHOT_H - NAV_H, SHOT_W, SHOT_H], fill=(240, 240, 240))
+        buf = io.BytesIO()
+        shot.save(buf, format="JPEG", quality=quality)
+        shots.append(buf.getvalue())
+    return shots
+
+
+def _worker(mode, shots_dir):
+    from services import llm_client, ocr_service  # type: ignore
+    shots = [pathlib.Path(shots_dir, name).read_bytes() for name in sorted(os.listdir(shots_dir))]
+    t0 = time.perf_counter()
+    if mode == "baseline":
+        payload, dims = b"", (0, 0)
+    elif mode == "legacy":
+        # 舊做法：全解析度 RGB 拼接，SDK 上傳前再編成 PNG
+        img = ocr_service._stitch_images(shots)
+        buf = io.BytesIO()
+        img.save(buf, format="PNG")
+        payload = buf.getvalue()
+        dims = img.size
+    else:
+        payload, info = ocr_service.preprocess_images(shots)
+        dims = (info["width"], info["height"])
+    prep_s = time.perf_counter() - t0
+    if payload:
+        llm_client.generate(["ocr", {"mime_type": "image/jpeg", "data": payload}], kind="ocr")
+    llm_s = time.perf_counter() - t0 - prep_s
+    # ru_maxrss 是整個行程的高水位（Linux 單位 KB）；與 baseline 子行程相減得到影像處理的額外用量
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({"mode": mode, "prep_s": prep_s, "llm_s": llm_s, "payload": len(payload),
+                      "peak_mb": peak_kb / 1024.0, "dims": dims}))
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--shots", type=int, default=8, help="截圖張數")
+    ap.add_argument("--overlap", type=float, default=0.3, help="相鄰截圖的重疊比例")
+    ap.add_argument("--uplink-mbps", type=float, default=20.0, help="估算上傳時間用的頻寬")
+    ap.add_argument("--llm-ms", type=float, default=1500.0, help="stub 模型延遲")
+    ap.add_argument("--worker", choices=("make", "baseline", "legacy", "preprocess"), help=argparse.SUPPRESS)
+    ap.add_argument("--shots-dir", help=argparse.SUPPRESS)
+    args = ap.parse_args(argv)
+    if args.worker == "make":
+        for i, b in enumerate(make_screenshots(args.shots, args.overlap)):
+            pathlib.Path(args.shots_dir, f"{i:03d}.jpg").write_bytes(b)
+        return
+    if args.worker:
+        return _worker(args.worker, args.shots_dir)
+
+    env = dict(os.environ, LLM_PROVIDER="stub", LLM_STUB_LATENCY_MS=str(args.llm_ms), LLM_STUB_JITTER_MS="0")
+    root = str(pathlib.Path(__file__).resolve().parent.parent)
+    env["PYTHONPATH"] = os.pathsep.join(p for p in (root, env.get("PYTHONPATH")) if p)
+    with tempfile.TemporaryDirectory() as tmp:
+        def run(mode):
+            # 每種做法都在新的子行程跑；Linux 的 ru_maxrss 會從父行程繼承，所以父行程本身不產圖
+            return subprocess.run(
+                [sys.executable, "-m", "services.bench_ocr", "--worker", mode, "--shots-dir", tmp,
+                 "--shots", str(args.shots), "--overlap", str(args.overlap)],
+                env=env, cwd=root, capture_output=True, text=True, check=True,
+            ).stdout.strip().splitlines()
+
+        run("make")
+        size = sum(os.path.getsize(os.path.join(tmp, name)) for name in os.listdir(tmp))
+        print(f"{args.shots} screenshots {SHOT_W}x{SHOT_H}, {size / 1e6:.2f} MB JPEG input")
+        results = {mode: json.loads(run(mode)[-1]) for mode in ("baseline", "legacy", "preprocess")}
+        base_mb = results["baseline"]["peak_mb"]
+        print(f"{'mode':<11} {'canvas':>12} {'payload MB':>11} {'peak +MB':>9} {'prep s':>7} {'upload s':>9} {'e2e s':>6}")
+        for mode in ("legacy", "preprocess"):
+            r = results[mode]
+            upload_s = r["payload"] * 8 / (args.uplink_mbps * 1e6)
+            canvas = f"{r['dims'][0]}x{r['dims'][1]}"
+            print(f"{mode:<11} {canvas:>12} {r['payload'] / 1e6:11.2f} {r['peak_mb'] - base_mb:9.1f} {r['prep_s']:7.2f} "
+                  f"{upload_s:9.2f} {r['prep_s'] + upload_s + r['llm_s']:6.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""Benchmark one class-reminder tick: per-user polling vs. the set-based engine.
+
+Usage:
+    python -m services.bench_reminders
+    python -m services.bench_reminders --users 10000,100000 --classes 8 --repeat 5
+
+每個規模都會在暫存目錄建立獨立的 SQLite（不會碰到正式 DB_PATH）。
+"""
+import argparse, os, random, sys, pathlib, tempfile, time
+from datetime import datetime
+
+# allow running as script
+if __package__ is None:
+    sys.path.append(str(pathlib.Path(__file__).resolve().parent.parent))
+
+from services import db, reminder_service, schedule_service  # type: ignore
+
+SLOTS = [("08:10", "09:00"), ("09:10", "10:00"), ("10:10", "11:00"), ("11:10", "12:00"),
+         ("13:10", "14:00"), ("14:10", "15:00"), ("15:10", "16:00"), ("16:10", "17:00")]
+
+
+def _populate(n_users, classes_per_user, seed=42):
+    rnd = random.Random(seed)
+    db.init_db()
+    conn = db.get_conn()
+    conn.executemany(
+        "INSERT INTO users(user_id, notifications_on, reminder_window) VALUES (?,?,?)",
+        ((f"U{i:07d}", 1 if rnd.random() < 0.9 else 0, rnd.choice((10, 15, 15, 20, 30)))
+         for i in range(n_users)),
+    )
+    def rows():
+        for i in range(n_users):
+            for dow, (start, end) in rnd.sample([(d, s) for d in range(1, 6) for s in SLOTS], classes_per_user):
+                yield (f"U{i:07d}", f"Course {rnd.randint(1, 500)}", dow, start, end, "R101")
+    conn.executemany(
+        "INSERT INTO schedule(user_id, course_name, day_of_week, start_time, end_time, location) VALUES (?,?,?,?,?,?)",
+        rows(),
+    )
+    conn.commit()
+    conn.close()
+
+
+def _legacy_tick(now):
+    """舊版 tasks.remind_classes 的查詢路徑（不含推播）。"""
+    conn = db.get_conn()
+    users = conn.execute("SELECT * FROM users").fetchall()
+    conn.close()
+    due = 0
+    for u in users:
+        if not u['notifications_on']:
+            continue
+        window = int(u['reminder_window'] or 15)
+        due += len(schedule_service.find_upcoming_classes(u['user_id'], now, within_minutes=window))
+    return due
+
+
+def _engine_tick(now):
+    return len(reminder_service.find_due_classes(now))
+
+
+def _time(fn, now, repeat):
+    best, result = None, None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn(now)
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--users", default="10000,100000", help="逗號分隔的使用者數量")
+    ap.add_argument("--classes", type=int, default=8, help="每位使用者的課堂數")
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--legacy-repeat", type=int, default=1)
+    ap.add_argument("--no-legacy", action="store_true", help="只量新版引擎")
+    args = ap.parse_args(argv)
+
+    # 週一 09:55：第 2 節前夕，大多數 window 都會命中
+    now = datetime(2024, 9, 2, 9, 55, 0)
+    print(f"{'users':>8} {'rows':>9} {'legacy ms':>10} {'engine ms':>10} {'speedup':>8} {'due':>7}")
+    for n in [int(x) for x in args.users.split(",") if x.strip()]:
+        with tempfile.TemporaryDirectory() as tmp:
+            db.close_pool()
+            db.DB_PATH = os.path.join(tmp, "bench.sqlite3")
+            _populate(n, args.classes)
+            engine_s, due = _time(_engine_tick, now, args.repeat)
+            legacy_s, legacy_due = (None, None)
+            if not args.no_legacy:
+                legacy_s, legacy_due = _time(_legacy_tick, now, args.legacy_repeat)
+                assert legacy_due == due, (legacy_due, due)
+            db.close_pool()
+        legacy_ms = f"{legacy_s * 1000:10.1f}" if legacy_s is not None else f"{'-':>10}"
+        speedup = f"{legacy_s / engine_s:7.0f}x" if legacy_s else f"{'-':>8}"
+        print(f"{n:>8} {n * args.classes:>9} {legacy_ms} {engine_s * 1000:10.1f} {speedup} {due:>7}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,22 @@
 
-import os, sqlite3, pathlib, threading
+import functools, os, sqlite3, pathlib, threading, time
+from datetime import datetime
 
-DB_PATH = os.environ.get("DB_PATH", str(pathlib.Path(__file__).resolve().parent.parent / "data" / "db.sqlite3"))
+try:
+    import fcntl
+except ImportError:  # Windows：沒有 flock，改靠 SQLite 自己的寫入鎖
+    fcntl = None
+
+DB_PATH = os.environ.get("DB_PATH") or str(pathlib.Path(__file__).resolve().parent.parent / "data" / "db.sqlite3")
 _lock = threading.Lock()
 
+# --- Connection tuning（可用環境變數覆寫）---
+POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "8"))
+BUSY_TIMEOUT_MS = int(os.environ.get("DB_BUSY_TIMEOUT_MS", "5000"))
+CACHE_SIZE_KB = int(os.environ.get("DB_CACHE_SIZE_KB", "8192"))
+MMAP_SIZE = int(os.environ.get("DB_MMAP_SIZE", str(64 * 1024 * 1024)))
+SYNCHRONOUS = os.environ.get("DB_SYNCHRONOUS", "NORMAL").upper()
+
 SCHEMA = [
     """CREATE TABLE IF NOT EXISTS users (
         user_id TEXT PRIMARY KEY,
@@ -51,7 +64,7 @@ SCHEMA = [
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         user_id TEXT,
         url TEXT
-    );"""
+    );""",
     """CREATE TABLE IF NOT EXISTS accounts (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         email TEXT UNIQUE,
@@ -69,48 +82,589 @@ SCHEMA = [
     );""",
 ]
 
-def get_conn():
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+# --- Connection pool ---
+# get_conn() 回傳的是 PooledConnection：呼叫端照舊 conn.close()，實際上只是把連線還回池子。
+# 同一個 thread 內巢狀呼叫會共用同一條連線；外層已有未 commit 的寫入時，內層改用 SAVEPOINT，
+# 內層的 commit / rollback 只影響自己那段，不會提前 commit 或丟掉外層的變更。
+# Flask request 期間連線會固定在該 request，直到 teardown 才歸還（見 init_app）；
+# 背景 thread 的工作以 release_thread_conn / background_job 在結束時強制歸還。
+_idle = []
+_local = threading.local()
+_pool_pid = os.getpid()
+_stats = {"opened": 0, "closed": 0, "checkouts": 0, "reused": 0, "in_use": 0, "leaked": 0}
+
+
+def _connect():
+    conn = sqlite3.connect(DB_PATH, timeout=BUSY_TIMEOUT_MS / 1000.0, check_same_thread=False)
     conn.row_factory = sqlite3.Row
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(f"PRAGMA synchronous={SYNCHRONOUS}")
+    conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store=MEMORY")
     return conn
 
-def init_db():
-    conn = get_conn()
-    cur = conn.cursor()
-    for ddl in SCHEMA:
-        s = (ddl or "").strip()
-        if not s:
-            continue
-        if not s.endswith(";"):
-            s += ";"
-        cur.executescript(s)
-    conn.commit()
-    conn.close()
 
-def _ensure_columns():
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("PRAGMA table_info(users)")
-    cols = [r[1] for r in cur.fetchall()]
-    if 'target_lang' not in cols:
+def _check_fork():
+    """gunicorn fork 之後不可沿用父行程的 sqlite 連線，直接丟掉重新計數。"""
+    global _pool_pid, _local
+    if os.getpid() == _pool_pid:
+        return
+    _idle.clear()
+    _local = threading.local()
+    for k in _stats:
+        _stats[k] = 0
+    _pool_pid = os.getpid()
+
+
+def _checkout():
+    with _lock:
+        _check_fork()
+        _stats["checkouts"] += 1
+        _stats["in_use"] += 1
+        if _idle:
+            _stats["reused"] += 1
+            return _idle.pop()
+        _stats["opened"] += 1
+    try:
+        return _connect()
+    except Exception:
+        with _lock:
+            _stats["opened"] -= 1
+            _stats["in_use"] -= 1
+        raise
+
+
+def _checkin(raw):
+    if raw.in_transaction:
+        # 與原本 close() 語意一致：未 commit 的變更一律丟棄
+        raw.rollback()
+    with _lock:
+        _stats["in_use"] -= 1
+        if len(_idle) < POOL_SIZE:
+            _idle.append(raw)
+            return
+        _stats["closed"] += 1
+    raw.close()
+
+
+def _state():
+    st = _local
+    if not hasattr(st, "conn"):
+        st.conn = None
+        st.depth = 0
+        st.pinned = False
+        st.savepoints = 0
+    return st
+
+
+def _release():
+    st = _state()
+    st.depth = max(st.depth - 1, 0)
+    if st.depth or st.conn is None:
+        return
+    if st.pinned:
+        if st.conn.in_transaction:
+            st.conn.rollback()
+        return
+    raw, st.conn = st.conn, None
+    _checkin(raw)
+
+
+class PooledConnection:
+    """sqlite3.Connection proxy；close() 把連線還給 pool 而不是真的關閉。
+
+    savepoint 不為 None 表示這是巢狀 checkout：commit() 只 RELEASE 自己的 savepoint，
+    rollback() / 沒 commit 就 close() 只回到 savepoint，外層的 transaction 不受影響。
+    """
+
+    __slots__ = ("_raw", "_released", "_savepoint", "_nested", "_began")
+
+    def __init__(self, raw, savepoint=None, nested=False):
+        self._raw = raw
+        self._released = False
+        self._savepoint = savepoint
+        self._nested = nested
+        # 巢狀 checkout 自己的語句開了 transaction（不是外層開的）才為 True
+        self._began = False
+        if savepoint:
+            raw.execute(f"SAVEPOINT {savepoint}")
+
+    def _track(self, fn, *args):
+        if not self._nested or self._savepoint or self._raw.in_transaction:
+            return fn(*args)
+        cur = fn(*args)
+        if self._raw.in_transaction:
+            self._began = True
+        return cur
+
+    def execute(self, *args):
+        return self._track(self._raw.execute, *args)
+
+    def executemany(self, *args):
+        return self._track(self._raw.executemany, *args)
+
+    def commit(self):
+        if not self._savepoint:
+            self._began = False
+            return self._raw.commit()
+        if self._raw.in_transaction:
+            # RELEASE 後重新開一個同名 savepoint，之後的語句仍只屬於內層
+            self._raw.execute(f"RELEASE {self._savepoint}")
+            self._raw.execute(f"SAVEPOINT {self._savepoint}")
+
+    def rollback(self):
+        if not self._savepoint:
+            self._began = False
+            return self._raw.rollback()
+        if self._raw.in_transaction:
+            self._raw.execute(f"ROLLBACK TO {self._savepoint}")
+
+    def close(self):
+        if self._released:
+            return
+        self._released = True
+        if self._savepoint:
+            _state().savepoints -= 1
+            if self._raw.in_transaction:
+                self._raw.execute(f"ROLLBACK TO {self._savepoint}")
+                self._raw.execute(f"RELEASE {self._savepoint}")
+        elif self._began and self._raw.in_transaction:
+            # 內層自己開的 transaction 沒 commit 就 close：丟棄，不留給外層一起 commit；
+            # 外層在內層 checkout 之後才開始的寫入不動
+            self._raw.rollback()
+        _release()
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def __enter__(self):
+        if not self._savepoint:
+            self._raw.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if not self._savepoint:
+            self._began = False
+            return self._raw.__exit__(exc_type, exc, tb)
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+        return False
+
+
+def get_conn():
+    with _lock:
+        _check_fork()
+    st = _state()
+    savepoint = None
+    nested = st.conn is not None
+    if st.conn is None:
+        st.conn = _checkout()
+    elif st.conn.in_transaction:
+        # 外層還有未 commit 的寫入：內層包在 savepoint 裡
+        st.savepoints += 1
+        savepoint = f"sp_nested_{st.savepoints}"
+    st.depth += 1
+    try:
+        return PooledConnection(st.conn, savepoint, nested)
+    except BaseException:
+        if savepoint:
+            st.savepoints -= 1
+        _release()
+        raise
+
+
+def release_thread_conn():
+    """歸還這個 thread 還握著的連線（忘了 close 或中途丟例外的也算），未 commit 的一律 rollback。
+
+    背景 thread（BackgroundPool、APScheduler、feed fetch）每個工作結束時呼叫；
+    Flask request 期間的連線由 teardown 處理，這裡不動。
+    """
+    st = _state()
+    if st.pinned:
+        return
+    if st.depth and st.conn is not None:
+        with _lock:
+            _stats["leaked"] += 1
+    st.depth = 0
+    st.savepoints = 0
+    if st.conn is not None:
+        raw, st.conn = st.conn, None
+        _checkin(raw)
+
+
+def background_job(fn):
+    """decorator：工作結束（含丟例外）後呼叫 release_thread_conn。"""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
         try:
-            cur.execute("ALTER TABLE users ADD COLUMN target_lang TEXT DEFAULT 'zh-Hant'")
-            conn.commit()
-        except Exception:
-            pass
+            return fn(*args, **kwargs)
+        finally:
+            release_thread_conn()
+    return wrapper
+
+
+def _pin_request_conn():
+    _state().pinned = True
+
+
+def _release_request_conn(exc=None):
+    st = _state()
+    st.pinned = False
+    # request 期間忘了 close 的由 teardown 收回，不算 leaked
+    st.depth = 0
+    release_thread_conn()
+
+
+def init_app(app):
+    """讓每個 Flask request 共用一條連線，並在 teardown 自動歸還（即使呼叫端忘了 close）。"""
+    app.before_request(_pin_request_conn)
+    app.teardown_request(_release_request_conn)
+
+
+def connection_stats():
+    with _lock:
+        _check_fork()
+        out = dict(_stats)
+        out["idle"] = len(_idle)
+    out["pid"] = os.getpid()
+    out["pool_size"] = POOL_SIZE
+    return out
+
+
+def close_pool():
+    """關閉所有閒置連線（測試 / 行程結束時使用）。"""
+    with _lock:
+        idle = list(_idle)
+        _idle.clear()
+        _stats["closed"] += len(idle)
+    for raw in idle:
+        raw.close()
+
+# --- Schema migrations ---
+# 每個 migration 是 (version, name, steps)；steps 可以是 SQL 字串或 callable(conn)。
+# 新的 schema 變更一律往後追加，不要修改已發佈的版本。
+
+def _add_user_columns(conn):
+    cols = [r[1] for r in conn.execute("PRAGMA table_info(users)").fetchall()]
+    if 'target_lang' not in cols:
+        conn.execute("ALTER TABLE users ADD COLUMN target_lang TEXT DEFAULT 'zh-Hant'")
     if 'notifications_on' not in cols:
-        try:
-            cur.execute("ALTER TABLE users ADD COLUMN notifications_on INTEGER DEFAULT 1")
-            conn.commit()
-        except Exception:
-            pass
+        conn.execute("ALTER TABLE users ADD COLUMN notifications_on INTEGER DEFAULT 1")
     if 'reminder_window' not in cols:
+        conn.execute("ALTER TABLE users ADD COLUMN reminder_window INTEGER DEFAULT 15")
+
+
+MIGRATIONS = [
+    (1, "base_schema", SCHEMA),
+    (2, "users_reminder_columns", [_add_user_columns]),
+    (3, "hot_path_indexes", [
+        # schedule_service：WHERE user_id=? AND day_of_week=? ORDER BY start_time / 衝堂檢查
+        "CREATE INDEX IF NOT EXISTS idx_schedule_user_dow_start ON schedule(user_id, day_of_week, start_time)",
+        # notes_service：WHERE user_id=? ORDER BY ts / 依日期區間查詢；tasks 的 DISTINCT user_id
+        "CREATE INDEX IF NOT EXISTS idx_notes_user_ts ON notes(user_id, ts)",
+        # news_service：keywords / feeds WHERE user_id=? (AND keyword|url=?)
+        "CREATE INDEX IF NOT EXISTS idx_keywords_user_kw ON keywords(user_id, keyword)",
+        "CREATE INDEX IF NOT EXISTS idx_feeds_user_url ON feeds(user_id, url)",
+        # accounts WHERE line_user_id=?
+        "CREATE INDEX IF NOT EXISTS idx_accounts_line_user ON accounts(line_user_id)",
+    ]),
+    (4, "reminder_engine_indexes", [
+        # 舊資料可能存成 "9:00"，統一補零，字串比較才會跟時間順序一致
+        "UPDATE schedule SET start_time='0'||start_time WHERE start_time GLOB '[0-9]:[0-9][0-9]'",
+        "UPDATE schedule SET end_time='0'||end_time WHERE end_time GLOB '[0-9]:[0-9][0-9]'",
+        # reminder_service：跨使用者掃 WHERE day_of_week=? AND start_time BETWEEN ? AND ?
+        "CREATE INDEX IF NOT EXISTS idx_schedule_dow_start ON schedule(day_of_week, start_time)",
+        # MAX(reminder_window) WHERE notifications_on=1 → 單次 index seek
+        "CREATE INDEX IF NOT EXISTS idx_users_notify_window ON users(notifications_on, reminder_window)",
+    ]),
+    (5, "reminder_ledger", [
+        # 以 occurrence_date 開頭：查「今天已送出」與刪除過期資料都是 PK 區間操作
+        """CREATE TABLE IF NOT EXISTS reminder_ledger (
+            occurrence_date TEXT,
+            user_id TEXT,
+            schedule_id INTEGER,
+            sent_at TEXT,
+            PRIMARY KEY (occurrence_date, user_id, schedule_id)
+        ) WITHOUT ROWID""",
+    ]),
+    (6, "feed_cache", [
+        """CREATE TABLE IF NOT EXISTS feed_cache (
+            url TEXT PRIMARY KEY,
+            kind TEXT,
+            etag TEXT,
+            modified TEXT,
+            entries_json TEXT,
+            fetched_at REAL,
+            checked_at REAL
+        )""",
+    ]),
+    (7, "news_store", [
+        """CREATE TABLE IF NOT EXISTS news_items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            url TEXT UNIQUE,
+            feed TEXT,
+            title TEXT,
+            summary TEXT,
+            published TEXT,
+            published_at TEXT,
+            indexed_at TEXT
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_news_items_feed_pub ON news_items(feed, published_at)",
+        "CREATE INDEX IF NOT EXISTS idx_news_items_indexed ON news_items(indexed_at)",
+        """CREATE TABLE IF NOT EXISTS news_terms (
+            term TEXT,
+            item_id INTEGER,
+            weight REAL,
+            PRIMARY KEY (term, item_id)
+        ) WITHOUT ROWID""",
+        "CREATE INDEX IF NOT EXISTS idx_news_terms_item ON news_terms(item_id)",
+    ]),
+    (8, "news_deliveries", [
+        # 每位使用者各自的推播紀錄；取代以 URL 全域去重的 news_cache
+        """CREATE TABLE IF NOT EXISTS news_deliveries (
+            user_id TEXT,
+            url TEXT,
+            title TEXT,
+            sent_at TEXT,
+            PRIMARY KEY (user_id, url)
+        ) WITHOUT ROWID""",
+        "CREATE INDEX IF NOT EXISTS idx_news_deliveries_sent ON news_deliveries(sent_at)",
+        # 舊版 news_cache 記的是「已推播過的 URL」（不分使用者）：當成每位現有關鍵字訂閱者都收過，
+        # 否則上線後第一輪 crawl 會把大家收過的新聞再推一次。sent_at 用遷移當下，保留一整個週期
+        """INSERT OR IGNORE INTO news_deliveries(user_id, url, title, sent_at)
+           SELECT k.user_id, n.url, n.title, strftime('%Y-%m-%dT%H:%M:%S', 'now', 'localtime')
+           FROM news_cache n
+           CROSS JOIN (SELECT DISTINCT user_id FROM keywords WHERE user_id IS NOT NULL) k
+           WHERE n.url IS NOT NULL AND n.url != ''""",
+    ]),
+    (9, "summary_cache", [
+        # key = sha256(prompt 版本 + model + 正規化後的筆記內容)
+        """CREATE TABLE IF NOT EXISTS summary_cache (
+            key TEXT PRIMARY KEY,
+            summary TEXT,
+            created_at REAL,
+            last_used_at REAL,
+            hits INTEGER DEFAULT 0
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_summary_cache_used ON summary_cache(last_used_at)",
+    ]),
+    (10, "notes_summary_status", [
+        # pending → 背景 worker 產生中；done / failed
+        "ALTER TABLE notes ADD COLUMN summary_status TEXT",
+        "UPDATE notes SET summary_status = CASE WHEN summary IS NULL OR summary = '' THEN 'pending' ELSE 'done' END",
+    ]),
+    (11, "notes_pending_index", [
+        # 只收錄待補摘要的筆記，背景 backfill 掃描成本與 backlog 大小成正比
+        "CREATE INDEX IF NOT EXISTS idx_notes_summary_pending ON notes(id) WHERE summary_status = 'pending'",
+    ]),
+    (12, "review_cache", [
+        # 回顧包快取；筆記增刪時把該使用者的列標成 stale，下次讀取再比對指紋
+        """
+        CREATE TABLE IF NOT EXISTS review_cache (
+            user_id TEXT NOT NULL,
+            scope TEXT NOT NULL,
+            fingerprint TEXT NOT NULL,
+            pack TEXT NOT NULL,
+            stale INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL,
+            PRIMARY KEY (user_id, scope)
+        ) WITHOUT ROWID
+        """,
+    ]),
+    (13, "upload_store", [
+        # LINE 課表圖片上傳流程：狀態與 spool 檔路徑（跨 worker 共用）
+        """
+        CREATE TABLE IF NOT EXISTS upload_sessions (
+            user_id TEXT PRIMARY KEY,
+            state TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            expires_at REAL NOT NULL
+        ) WITHOUT ROWID
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_upload_sessions_expires ON upload_sessions(expires_at)",
+        """
+        CREATE TABLE IF NOT EXISTS upload_images (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            path TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            created_at REAL NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_upload_images_user ON upload_images(user_id, id)",
+    ]),
+    (14, "ocr_cache", [
+        # 課表 OCR 結果快取：key 為整組圖片內容雜湊，LRU 淘汰
+        """
+        CREATE TABLE IF NOT EXISTS ocr_cache (
+            key TEXT PRIMARY KEY,
+            courses_json TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            last_used_at REAL NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_ocr_cache_last_used ON ocr_cache(last_used_at)",
+    ]),
+    (15, "ocr_jobs", [
+        # 課表 OCR 匯入改成背景工作：status queued → running → done / failed，
+        # 圖片放在 image_dir，結果（匯入筆數、失敗訊息）存在 result_json
+        """
+        CREATE TABLE IF NOT EXISTS ocr_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            source TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            refresh INTEGER NOT NULL DEFAULT 0,
+            image_dir TEXT NOT NULL,
+            n_images INTEGER NOT NULL DEFAULT 0,
+            result_json TEXT,
+            error TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL,
+            started_at REAL,
+            finished_at REAL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_ocr_jobs_status ON ocr_jobs(status, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_ocr_jobs_user ON ocr_jobs(user_id, id)",
+    ]),
+    (16, "news_items_per_feed", [
+        # 同一篇新聞可能同時出現在多個來源：改以 (feed, url) 唯一，每個來源都搜得到。
+        # 重建表格並保留原本的 id，news_terms 的 item_id 不用動
+        """CREATE TABLE news_items_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            url TEXT,
+            feed TEXT,
+            title TEXT,
+            summary TEXT,
+            published TEXT,
+            published_at TEXT,
+            indexed_at TEXT,
+            UNIQUE (feed, url)
+        )""",
+        """INSERT INTO news_items_new(id, url, feed, title, summary, published, published_at, indexed_at)
+           SELECT id, url, feed, title, summary, published, published_at, indexed_at FROM news_items""",
+        "DROP TABLE news_items",
+        "ALTER TABLE news_items_new RENAME TO news_items",
+        "CREATE INDEX IF NOT EXISTS idx_news_items_feed_pub ON news_items(feed, published_at)",
+        "CREATE INDEX IF NOT EXISTS idx_news_items_indexed ON news_items(indexed_at)",
+    ]),
+    (17, "ocr_jobs_owner", [
+        # 持有工作的行程（host:pid）與最後一次 claim / 排入的時間；recover_stale 只撿真的沒人顧的工作
+        "ALTER TABLE ocr_jobs ADD COLUMN owner TEXT",
+        "ALTER TABLE ocr_jobs ADD COLUMN heartbeat_at REAL",
+    ]),
+    (18, "notes_summary_claim", [
+        # 產生摘要前先搶：summary_worker / 排程 backfill / backfill CLI 不會對同一則筆記重複呼叫 LLM
+        "ALTER TABLE notes ADD COLUMN summary_claimed_at REAL",
+    ]),
+]
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+class FileLock:
+    """跨行程的檔案鎖（fcntl.flock）；blocking=False 時拿不到鎖就把 acquired 設為 False。
+
+    用來避免多個 gunicorn worker 同時跑 migration 或同一個背景工作。
+    """
+
+    def __init__(self, path, blocking=True):
+        self.path = path
+        self.blocking = blocking
+        self.acquired = False
+        self._fh = None
+
+    def __enter__(self):
+        if fcntl is None:
+            self.acquired = True
+            return self
+        self._fh = open(self.path, "a")
+        flags = fcntl.LOCK_EX if self.blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
         try:
-            cur.execute("ALTER TABLE users ADD COLUMN reminder_window INTEGER DEFAULT 15")
+            fcntl.flock(self._fh, flags)
+            self.acquired = True
+        except BlockingIOError:
+            self._fh.close()
+            self._fh = None
+        return self
+
+    def __exit__(self, *exc):
+        if self._fh is not None:
+            fcntl.flock(self._fh, fcntl.LOCK_UN)
+            self._fh.close()
+            self._fh = None
+        self.acquired = False
+
+
+def job_lock(name):
+    """同一台機器上只讓一個行程執行名為 name 的背景工作：with job_lock(...) as lk: if lk.acquired: ..."""
+    return FileLock(f"{DB_PATH}.{name}.lock", blocking=False)
+
+
+def _schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def _apply_migration(conn, version, name, steps):
+    started = time.perf_counter()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for step in steps:
+            if callable(step):
+                step(conn)
+            else:
+                conn.execute(step)
+        duration_ms = (time.perf_counter() - started) * 1000.0
+        conn.execute(
+            "INSERT OR REPLACE INTO schema_version(version, name, applied_at, duration_ms) VALUES (?,?,?,?)",
+            (version, name, datetime.now().isoformat(timespec='seconds'), round(duration_ms, 3)),
+        )
+        conn.execute(f"PRAGMA user_version={int(version)}")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    print(f"[db] migration {version} ({name}) applied in {duration_ms:.1f} ms")
+
+
+def init_db():
+    """套用尚未執行的 migration；schema 已是最新時只讀一次 user_version 就返回。"""
+    conn = get_conn()
+    try:
+        if _schema_version(conn) >= LATEST_VERSION:
+            return
+        with FileLock(DB_PATH + ".migrate.lock"):
+            # 拿到鎖之後再確認一次，可能已被其他 worker 做完
+            current = _schema_version(conn)
+            if current >= LATEST_VERSION:
+                return
+            conn.execute("""CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                name TEXT,
+                applied_at TEXT,
+                duration_ms REAL
+            )""")
             conn.commit()
-        except Exception:
-            pass
+            for version, name, steps in MIGRATIONS:
+                if version > current:
+                    _apply_migration(conn, version, name, steps)
+    finally:
+        conn.close()
+
+
+def applied_migrations():
+    conn = get_conn()
+    try:
+        rows = conn.execute("SELECT * FROM schema_version ORDER BY version").fetchall()
+    except sqlite3.OperationalError:
+        rows = []
     conn.close()
+    return [dict(r) for r in rows]
 
 def ensure_user(user_id: str):
     conn = get_conn()
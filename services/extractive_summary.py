@@ -0,0 +1,106 @@
+"""Extractive note summarizer (TF-IDF sentence scoring, no LLM).
+
+- 斷句：換行與中英文句末標點（。！？；.!?;），條列符號會先去掉
+- 詞：CJK 取相鄰兩字（bigram），英數取整個單字；先做 NFKC + casefold
+- 每句是一個 TF-IDF 向量，分數 = 與整篇重心向量的 cosine（越能代表全文越高）
+  + 開頭句的位置加權；挑分數最高的幾句，依原文順序輸出成條列
+
+純 Python 實作，一則筆記在毫秒等級內完成，適合放在 add_note 的熱路徑上。
+"""
+import math
+import re
+
+from .keyword_matcher import normalize
+
+_SPLIT = re.compile(r"(?<=[。！？；!?;])|(?<=\.)\s+|\n+")
+_BULLET = re.compile(r"^\s*(?:[•\-*·●○▪]|\d+[.)、]|[（(]?\d+[)）])\s*")
+_WORD = re.compile(r"[a-z0-9][a-z0-9_+#.-]*")
+
+
+def _is_cjk(ch):
+    return "㐀" <= ch <= "鿿" or "豈" <= ch <= "﫿" or "぀" <= ch <= "ヿ"
+
+
+def split_sentences(text):
+    out = []
+    for part in _SPLIT.split(text or ""):
+        part = _BULLET.sub("", part or "").strip()
+        if part:
+            out.append(part)
+    return out
+
+
+def _terms(sentence):
+    s = normalize(sentence)
+    terms = _WORD.findall(s)
+    run = []
+    for ch in s + " ":
+        if _is_cjk(ch):
+            run.append(ch)
+            continue
+        if len(run) == 1:
+            terms.append(run[0])
+        terms.extend(run[i] + run[i + 1] for i in range(len(run) - 1))
+        run = []
+    return terms
+
+
+def _tfidf(sentence_terms):
+    n = len(sentence_terms)
+    df = {}
+    for terms in sentence_terms:
+        for t in set(terms):
+            df[t] = df.get(t, 0) + 1
+    vectors = []
+    for terms in sentence_terms:
+        vec = {}
+        for t in terms:
+            vec[t] = vec.get(t, 0) + 1
+        for t, tf in vec.items():
+            vec[t] = (1 + math.log(tf)) * (math.log((1 + n) / (1 + df[t])) + 1)
+        vectors.append(vec)
+    return vectors
+
+
+def _cosine(a, b):
+    if not a or not b:
+        return 0.0
+    if len(a) > len(b):
+        a, b = b, a
+    dot = sum(v * b.get(t, 0.0) for t, v in a.items())
+    na = math.sqrt(sum(v * v for v in a.values()))
+    nb = math.sqrt(sum(v * v for v in b.values()))
+    return dot / (na * nb) if na and nb else 0.0
+
+
+def rank_sentences(sentences):
+    """回傳每句的分數（與 sentences 對齊）。"""
+    vectors = _tfidf([_terms(s) for s in sentences])
+    centroid = {}
+    for vec in vectors:
+        for t, v in vec.items():
+            centroid[t] = centroid.get(t, 0.0) + v
+    scores = []
+    for i, vec in enumerate(vectors):
+        position = 0.15 if i == 0 else 0.05 if i == 1 else 0.0
+        # 太短的句子（例如「重點：」）資訊量低
+        length = min(1.0, len(sentences[i]) / 12.0)
+        scores.append(_cosine(vec, centroid) * length + position)
+    return scores
+
+
+def summarize(text, max_sentences=4, max_chars=120):
+    """挑出最具代表性的幾句，依原文順序以「• 」條列；沒有內容回傳 None。"""
+    sentences = split_sentences(text)
+    if not sentences:
+        return None
+    if len(sentences) > max_sentences:
+        scores = rank_sentences(sentences)
+        keep = sorted(sorted(range(len(sentences)), key=lambda i: -scores[i])[:max_sentences])
+        sentences = [sentences[i] for i in keep]
+    bullets = []
+    for s in sentences:
+        if len(s) > max_chars:
+            s = s[:max_chars - 3] + "..."
+        bullets.append(f"• {s}")
+    return "\n".join(bullets)
@@ -0,0 +1,254 @@
+"""Feed fetching with a shared, validator-aware cache.
+
+每個來源（RSS 或一般網頁）在 feed_cache 表存一份：ETag / Last-Modified 與解析後的項目。
+- TTL 內（NEWS_FEED_TTL 秒）直接回傳快取，不發任何請求；
+- 過了 TTL 就帶 If-None-Match / If-Modified-Since 發 conditional GET，304 時只更新檢查時間；
+- 來源暫時掛掉時回傳上一次的結果（stale）。
+快取放在 SQLite，所以同一台機器上的 gunicorn worker 與排程器共用。
+
+fetch_many() 平行抓多個來源：全域並行上限（NEWS_FETCH_CONCURRENCY）、每個 host 的上限
+（NEWS_FETCH_PER_HOST）與整體 deadline；deadline 前完成的先回傳，慢的來源在背景抓完後
+會寫進快取，下一次查詢就能用。
+"""
+import json
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from urllib.parse import urljoin, urlsplit
+
+import feedparser
+import requests
+from bs4 import BeautifulSoup
+
+from .db import get_conn, release_thread_conn
+
+FEED_TTL = int(os.environ.get("NEWS_FEED_TTL", "600"))
+HTTP_TIMEOUT = 8
+MAX_CACHED_ENTRIES = 200
+FETCH_CONCURRENCY = int(os.environ.get("NEWS_FETCH_CONCURRENCY", "8"))
+FETCH_PER_HOST = int(os.environ.get("NEWS_FETCH_PER_HOST", "2"))
+FETCH_DEADLINE = float(os.environ.get("NEWS_FETCH_DEADLINE", "6"))
+
+_stats_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0, "not_modified": 0, "errors": 0, "stale_served": 0, "late": 0}
+
+_pool_lock = threading.Lock()
+_pool = None
+_pool_pid = None
+# host → {"active": 執行中數量, "waiting": 排隊中的 (future, url, limit, max_age)}
+_hosts = {}
+
+
+def _count(key):
+    with _stats_lock:
+        _stats[key] += 1
+
+
+def cache_stats():
+    with _stats_lock:
+        out = dict(_stats)
+    lookups = out["hits"] + out["misses"] + out["not_modified"] + out["errors"]
+    for key in ("hits", "misses", "not_modified"):
+        out[f"{key}_rate"] = round(out[key] / lookups, 3) if lookups else 0.0
+    out["ttl_seconds"] = FEED_TTL
+    return out
+
+
+def _normalize(entries, feed_url):
+    items = []
+    for e in entries:
+        items.append({
+            "title": e.get('title', ''),
+            "summary": e.get('summary', '') or e.get('desc', ''),
+            "link": e.get('link', '') or e.get('url', ''),
+            "published": e.get('published', '') or '',
+            "feed": feed_url,
+        })
+    return items
+
+
+def _parse_html_links(html, feed_url, limit=200):
+    """Fallback：對非 RSS 頁面簡單抓取 <a> 連結作為項目。"""
+    soup = BeautifulSoup(html, "html.parser")
+    links = []
+    for a in soup.find_all("a"):
+        title = (a.get_text() or "").strip()
+        href = a.get("href")
+        if not title or not href:
+            continue
+        if href.startswith("#"):
+            continue
+        if len(title) < 4:
+            continue
+        links.append({
+            "title": title,
+            "summary": "",
+            "link": urljoin(feed_url, href),
+            "feed": feed_url,
+        })
+        if len(links) >= limit:
+            break
+    return links
+
+
+def _load(url):
+    conn = get_conn()
+    row = conn.execute("SELECT * FROM feed_cache WHERE url=?", (url,)).fetchone()
+    conn.close()
+    return dict(row) if row else None
+
+
+def _store(url, kind, etag, modified, entries):
+    now = time.time()
+    conn = get_conn()
+    conn.execute(
+        """INSERT OR REPLACE INTO feed_cache(url, kind, etag, modified, entries_json, fetched_at, checked_at)
+           VALUES (?,?,?,?,?,?,?)""",
+        (url, kind, etag, modified, json.dumps(entries[:MAX_CACHED_ENTRIES], ensure_ascii=False), now, now),
+    )
+    conn.commit()
+    conn.close()
+
+
+def _touch(url):
+    conn = get_conn()
+    conn.execute("UPDATE feed_cache SET checked_at=? WHERE url=?", (time.time(), url))
+    conn.commit()
+    conn.close()
+
+
+def _fetch(url, cached):
+    """單次 GET（帶 validator），先當 RSS/Atom 解析，解析不到項目再當網頁抓 <a>。
+
+    回傳 (status, kind, entries, etag, modified)；status 為 304 表示沿用快取。
+    """
+    headers = {}
+    if cached:
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("modified"):
+            headers["If-Modified-Since"] = cached["modified"]
+    resp = requests.get(url, timeout=HTTP_TIMEOUT, headers=headers)
+    if resp.status_code == 304:
+        return 304, None, None, None, None
+    resp.raise_for_status()
+    etag, modified = resp.headers.get("ETag"), resp.headers.get("Last-Modified")
+    # 已知是一般網頁就不用再跑 feedparser
+    if not cached or cached.get("kind") != "html":
+        d = feedparser.parse(resp.content)
+        if d.entries:
+            return resp.status_code, "rss", _normalize(d.entries[:MAX_CACHED_ENTRIES], url), etag, modified
+    entries = _normalize(_parse_html_links(resp.text, url, limit=MAX_CACHED_ENTRIES), url)
+    return resp.status_code, "html", entries, etag, modified
+
+
+def fetch_entries(url, limit=50, max_age=None):
+    """取得一個來源的項目（dict list），優先使用快取。
+
+    ``max_age`` 秒內檢查過的快取直接回傳；預設為 NEWS_FEED_TTL，傳 0 代表一定要重新驗證。
+    """
+    max_age = FEED_TTL if max_age is None else max_age
+    cached = _load(url)
+    if cached and time.time() - (cached.get("checked_at") or 0) < max_age:
+        _count("hits")
+        return json.loads(cached["entries_json"] or "[]")[:limit]
+
+    try:
+        status, kind, entries, etag, modified = _fetch(url, cached)
+    except Exception:
+        _count("errors")
+        if cached:
+            _count("stale_served")
+            return json.loads(cached["entries_json"] or "[]")[:limit]
+        raise
+
+    if status == 304 and cached:
+        _count("not_modified")
+        _touch(url)
+        return json.loads(cached["entries_json"] or "[]")[:limit]
+
+    _count("misses")
+    _store(url, kind, etag, modified, entries or [])
+    return (entries or [])[:limit]
+
+
+def _executor():
+    """每個行程一個共用 thread pool（fork 後重建）。"""
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ThreadPoolExecutor(max_workers=FETCH_CONCURRENCY, thread_name_prefix="feed-fetch")
+            _pool_pid = os.getpid()
+            _hosts.clear()
+        return _pool
+
+
+def _launch(host, fut, url, limit, max_age):
+    def run():
+        try:
+            fut.set_result(fetch_entries(url, limit=limit, max_age=max_age))
+        except BaseException as e:
+            fut.set_exception(e)
+        finally:
+            release_thread_conn()
+            _host_done(host)
+
+    _executor().submit(run)
+
+
+def _host_done(host):
+    with _pool_lock:
+        h = _hosts.get(host)
+        if h is None:
+            return
+        if not h["waiting"]:
+            h["active"] -= 1
+            if not h["active"]:
+                del _hosts[host]
+            return
+        nxt = h["waiting"].popleft()
+    _launch(host, *nxt)
+
+
+def _submit(url, limit, max_age):
+    """送出一個來源；同一 host 已有 FETCH_PER_HOST 個在跑時先排在該 host 的佇列，
+
+    等前一個完成才送進 pool，排隊中的來源不會佔住 worker thread，其他 host 不會被拖慢。
+    """
+    _executor()
+    fut = Future()
+    host = urlsplit(url).netloc.lower()
+    with _pool_lock:
+        h = _hosts.setdefault(host, {"active": 0, "waiting": deque()})
+        if h["active"] >= FETCH_PER_HOST:
+            h["waiting"].append((fut, url, limit, max_age))
+            return fut
+        h["active"] += 1
+    _launch(host, fut, url, limit, max_age)
+    return fut
+
+
+def fetch_many(urls, limit=50, max_age=None, deadline=FETCH_DEADLINE):
+    """平行取得多個來源，回傳 {url: entries}，只包含 deadline 前成功完成的來源。
+
+    ``deadline`` 為秒數，None 表示等全部完成。超時的來源不會被取消，抓完仍會更新快取。
+    """
+    urls = list(dict.fromkeys(u for u in urls if u))
+    if not urls:
+        return {}
+    futures = {_submit(u, limit, max_age): u for u in urls}
+    done, not_done = wait(futures, timeout=deadline)
+    if not_done:
+        with _stats_lock:
+            _stats["late"] += len(not_done)
+        print(f"[feed] {len(not_done)} feed(s) missed the {deadline}s deadline: "
+              f"{[futures[f] for f in not_done][:5]}")
+    results = {}
+    for fut in done:
+        try:
+            results[futures[fut]] = fut.result()
+        except Exception:
+            continue
+    return results
@@ -30,18 +30,22 @@ TOPICS = {
             "\n"
             "說明：\n"
             "  • 需要 GEMINI_API_KEY 才會附 AI 重點；沒設也會保存筆記\n"
+            "  • 筆記會先存檔回覆，AI 重點產生好後再另外推播\n"
             "  • 可在網站 /web/notes/manage 檢視/新增\n"
         )
     },
     "review": {
-        "title": "今日回顧包 (review)",
+        "title": "回顧包 (review)",
         "body": (
-            "用途：彙整今天的筆記為 4 區塊（摘要/名詞解釋/可能考點/練習題）\n"
+            "用途：彙整筆記為 4 區塊（摘要/名詞解釋/可能考點/練習題）\n"
             "指令：\n"
             "  /review today\n"
+            "  /review week | /review month\n"
+            "  /review course <課名>\n"
             "\n"
             "說明：\n"
             "  • 需要 GEMINI_API_KEY\n"
+            "  • 週/月/課程回顧包會在背景產生，完成後推播給你\n"
             "  • 也可在網站 /web/review 一鍵產生\n"
         )
     },
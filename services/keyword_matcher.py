@@ -0,0 +1,161 @@
+"""Aho-Corasick multi-keyword matcher.
+
+把所有訂閱者的關鍵字編成一個自動機，每則新聞只要掃過一次就能得到命中的關鍵字集合，
+再由關鍵字對回訂閱者；成本與「文字長度 + 命中數」成正比，不再是 entries × keywords。
+
+- 比對前對關鍵字與內文都做 NFKC + casefold，全形英數（ＡＩ）與大小寫都視為相同；
+  CJK 直接以字元為單位比對，不需要斷詞。
+- add / remove 只改 trie 與輸出集合，failure links 在下一次 match 前才重算（lazy rebuild）；
+  移除的關鍵字太多時整棵 trie 重建，避免留下大量無用節點。
+"""
+import threading
+import unicodedata
+
+
+def normalize(text):
+    return unicodedata.normalize("NFKC", text or "").casefold()
+
+
+class KeywordMatcher:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._subscribers = {}  # normalized keyword → set(user_id)
+        self._reset_trie()
+        self.rebuilds = 0
+
+    @classmethod
+    def from_keywords(cls, keywords, owner=None):
+        m = cls()
+        for kw in keywords:
+            m.add(kw, owner)
+        return m
+
+    def _reset_trie(self):
+        self._goto = [{}]
+        self._fail = [0]
+        self._own = [None]   # 在此節點結束的關鍵字
+        self._out = [()]     # 含 failure 鏈上的所有輸出，compile 時計算
+        self._dead = 0
+        self._dirty = False
+
+    def _insert(self, kw):
+        node = 0
+        for ch in kw:
+            nxt = self._goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[node][ch] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._own.append(None)
+                self._out.append(())
+            node = nxt
+        self._own[node] = kw
+        self._dirty = True
+
+    def _node_of(self, kw):
+        node = 0
+        for ch in kw:
+            node = self._goto[node].get(ch)
+            if node is None:
+                return None
+        return node
+
+    def add(self, keyword, user_id=None):
+        kw = normalize(keyword).strip()
+        if not kw:
+            return
+        with self._lock:
+            subs = self._subscribers.get(kw)
+            if subs is None:
+                subs = self._subscribers[kw] = set()
+                self._insert(kw)
+            subs.add(user_id)
+
+    def remove(self, keyword, user_id=None):
+        kw = normalize(keyword).strip()
+        with self._lock:
+            subs = self._subscribers.get(kw)
+            if subs is None:
+                return
+            subs.discard(user_id)
+            if subs:
+                return
+            del self._subscribers[kw]
+            node = self._node_of(kw)
+            if node is not None:
+                self._own[node] = None
+                self._dead += 1
+                self._dirty = True
+
+    def sync(self, user_keywords):
+        """讓內容與 {user_id: [keyword, ...]} 一致，只套用差異。"""
+        wanted = {}
+        for user_id, kws in user_keywords.items():
+            for kw in kws:
+                k = normalize(kw).strip()
+                if k:
+                    wanted.setdefault(k, set()).add(user_id)
+        with self._lock:
+            for kw in list(self._subscribers):
+                for user_id in self._subscribers[kw] - wanted.get(kw, set()):
+                    self.remove(kw, user_id)
+            for kw, users in wanted.items():
+                for user_id in users - self._subscribers.get(kw, set()):
+                    self.add(kw, user_id)
+
+    def _compile(self):
+        if self._dead and self._dead >= len(self._subscribers):
+            self._reset_trie()
+            for kw in self._subscribers:
+                self._insert(kw)
+        goto, fail, own, out = self._goto, self._fail, self._own, self._out
+        queue = []
+        for child in goto[0].values():
+            fail[child] = 0
+            queue.append(child)
+        out[0] = ()
+        i = 0
+        while i < len(queue):
+            node = queue[i]
+            i += 1
+            f_out = out[fail[node]]
+            out[node] = ((own[node],) + f_out) if own[node] is not None else f_out
+            for ch, child in goto[node].items():
+                f = fail[node]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                fail[child] = goto[f].get(ch, 0)
+                queue.append(child)
+        self._dirty = False
+        self.rebuilds += 1
+
+    def match(self, text):
+        """回傳 text 中出現的（正規化後）關鍵字集合。"""
+        text = normalize(text)
+        found = set()
+        with self._lock:
+            if self._dirty:
+                self._compile()
+            goto, fail, out = self._goto, self._fail, self._out
+            node = 0
+            for ch in text:
+                while node and ch not in goto[node]:
+                    node = fail[node]
+                node = goto[node].get(ch, 0)
+                if out[node]:
+                    found.update(out[node])
+        return found
+
+    def match_users(self, text):
+        """回傳 {user_id: {命中的關鍵字}}。"""
+        hits = {}
+        found = self.match(text)
+        with self._lock:
+            for kw in found:
+                for user_id in self._subscribers.get(kw, ()):
+                    hits.setdefault(user_id, set()).add(kw)
+        return hits
+
+    def __len__(self):
+        return len(self._subscribers)
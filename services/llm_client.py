@@ -0,0 +1,144 @@
+"""Shared LLM client: one warm model per process, rate limiting, retries and metrics.
+
+所有 LLM 呼叫（筆記摘要、回顧包、課表 OCR）都走這裡：
+- 實際呼叫交給 llm_providers（LLM_PROVIDER=gemini|stub），每個行程只建一次 model（fork 後重建）
+- token bucket 限制每分鐘呼叫數，semaphore 限制同時進行的呼叫數
+- 429 / 5xx / timeout 以指數退避重試
+- 記錄每種用途的呼叫數、延遲與 token 用量（/debug/metrics）
+"""
+import os
+import random
+import threading
+import time
+
+from .llm_providers import get_provider
+
+GEMINI_MODEL = os.environ.get("GEMINI_MODEL", "gemini-2.5-flash")
+# 每個行程的速率上限（每分鐘呼叫數）與瞬間可用的額度
+LLM_RPM = float(os.environ.get("LLM_RPM", "60"))
+LLM_BURST = int(os.environ.get("LLM_BURST", "10"))
+LLM_CONCURRENCY = int(os.environ.get("LLM_CONCURRENCY", "4"))
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", "3"))
+LLM_BACKOFF_BASE = float(os.environ.get("LLM_BACKOFF_BASE", "1.0"))
+LLM_BACKOFF_MAX = 30.0
+LLM_TIMEOUT = float(os.environ.get("LLM_TIMEOUT", "60"))
+
+# google.api_core 的暫時性錯誤（依類別名稱判斷，不必 import api_core）
+_RETRYABLE = {
+    "ResourceExhausted", "TooManyRequests", "ServiceUnavailable", "DeadlineExceeded",
+    "InternalServerError", "GatewayTimeout", "Aborted", "TimeoutError", "ConnectionError",
+}
+
+
+class TokenBucket:
+    """每秒補 rate 個 token、最多存 capacity 個；acquire 會阻塞到拿到為止。"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = max(1, capacity)
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class LLMError(Exception):
+    """重試後仍失敗；呼叫端應改用 fallback。"""
+
+
+_provider = get_provider(GEMINI_MODEL)
+# 快取 key 用：換 provider / 模型後舊的快取自然失效
+MODEL_NAME = _provider.model_name
+
+_lock = threading.Lock()
+_bucket = TokenBucket(LLM_RPM / 60.0, LLM_BURST)
+_slots = threading.BoundedSemaphore(LLM_CONCURRENCY)
+_stats = {"calls": 0, "errors": 0, "retries": 0, "throttled": 0, "throttle_ms_total": 0.0,
+          "prompt_tokens": 0, "output_tokens": 0}
+_by_kind = {}
+
+
+def available():
+    return _provider.available()
+
+
+def _is_retryable(exc):
+    if type(exc).__name__ in _RETRYABLE:
+        return True
+    code = getattr(exc, "code", None)
+    return code == 429 or (isinstance(code, int) and code >= 500)
+
+
+def _record(kind, latency_ms, ok, result=None):
+    with _lock:
+        k = _by_kind.setdefault(kind, {"calls": 0, "errors": 0, "latency_ms_total": 0.0, "latency_ms_max": 0.0})
+        k["calls"] += 1
+        k["latency_ms_total"] += latency_ms
+        k["latency_ms_max"] = max(k["latency_ms_max"], latency_ms)
+        _stats["calls"] += 1
+        if not ok:
+            k["errors"] += 1
+            _stats["errors"] += 1
+        if result is not None:
+            _stats["prompt_tokens"] += result.prompt_tokens
+            _stats["output_tokens"] += result.output_tokens
+
+
+def generate(contents, kind="text", generation_config=None):
+    """呼叫模型並回傳文字（已 strip）；沒有 API key 或重試用盡時丟 LLMError。"""
+    if not available():
+        raise LLMError(f"{_provider.name} provider is not configured")
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        waited = _bucket.acquire()
+        if waited:
+            with _lock:
+                _stats["throttled"] += 1
+                _stats["throttle_ms_total"] += waited * 1000.0
+        started = time.perf_counter()
+        with _slots:
+            try:
+                result = _provider.generate(contents, kind=kind, generation_config=generation_config,
+                                            timeout=LLM_TIMEOUT)
+            except Exception as e:
+                _record(kind, (time.perf_counter() - started) * 1000.0, False)
+                if attempt >= LLM_MAX_RETRIES or not _is_retryable(e):
+                    raise LLMError(f"{kind}: {e!r}") from e
+                err = e
+            else:
+                _record(kind, (time.perf_counter() - started) * 1000.0, True, result)
+                return result.text
+        delay = min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * (2 ** attempt)) * random.uniform(0.5, 1.0)
+        print(f"[llm] {kind} retry {attempt + 1}/{LLM_MAX_RETRIES} in {delay:.1f}s: {err!r}")
+        with _lock:
+            _stats["retries"] += 1
+        time.sleep(delay)
+
+
+def stats():
+    with _lock:
+        out = dict(_stats)
+        kinds = {name: dict(k) for name, k in _by_kind.items()}
+    for k in kinds.values():
+        k["latency_ms_avg"] = round(k["latency_ms_total"] / k["calls"], 1) if k["calls"] else 0.0
+        k["latency_ms_total"] = round(k["latency_ms_total"], 1)
+        k["latency_ms_max"] = round(k["latency_ms_max"], 1)
+    out["throttle_ms_total"] = round(out["throttle_ms_total"], 1)
+    out["by_kind"] = kinds
+    out["provider"] = _provider.name
+    out["model"] = MODEL_NAME
+    out["rpm"] = LLM_RPM
+    out["concurrency"] = LLM_CONCURRENCY
+    return out
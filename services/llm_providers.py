@@ -0,0 +1,149 @@
+"""LLM providers behind services.llm_client.
+
+LLM_PROVIDER=gemini（預設）走 Google Gemini；LLM_PROVIDER=stub 用本機假模型，
+可設定延遲與失敗率，回傳依用途（kind）決定的固定內容，方便離線壓測 /note、/review、OCR。
+"""
+import json
+import os
+import random
+import threading
+import time
+
+
+class LLMResult:
+    def __init__(self, text, prompt_tokens=0, output_tokens=0):
+        self.text = text
+        self.prompt_tokens = prompt_tokens
+        self.output_tokens = output_tokens
+
+
+class GeminiProvider:
+    name = "gemini"
+
+    def __init__(self, model_name):
+        self.model_name = model_name
+        self._lock = threading.Lock()
+        self._model = None
+        self._pid = None
+
+    def available(self):
+        return bool(os.environ.get("GEMINI_API_KEY"))
+
+    def _get_model(self):
+        with self._lock:
+            if self._model is None or self._pid != os.getpid():
+                import google.generativeai as genai
+                genai.configure(api_key=os.environ.get("GEMINI_API_KEY"))
+                self._model = genai.GenerativeModel(self.model_name)
+                self._pid = os.getpid()
+            return self._model
+
+    def generate(self, contents, kind="text", generation_config=None, timeout=None):
+        kwargs = {}
+        if timeout:
+            kwargs["request_options"] = {"timeout": timeout}
+        if generation_config:
+            kwargs["generation_config"] = generation_config
+        res = self._get_model().generate_content(contents, **kwargs)
+        try:
+            text = (res.text or "").strip()
+        except ValueError:
+            # 被安全過濾擋掉時 .text 會丟 ValueError，視為空結果
+            text = ""
+        usage = getattr(res, "usage_metadata", None)
+        return LLMResult(
+            text,
+            getattr(usage, "prompt_token_count", 0) or 0,
+            getattr(usage, "candidates_token_count", 0) or 0,
+        )
+
+
+class StubUnavailable(Exception):
+    """StubProvider 注入的暫時性錯誤（code=503，llm_client 會重試）。"""
+    code = 503
+
+
+_STUB_REVIEW = """【摘要】
+（stub）本段筆記的重點整理。
+
+【名詞解釋】
+- 名詞 A：說明。
+
+【可能考點】
+- 考點 1。
+
+【練習題】
+1. 練習題（提示：回顧筆記）。"""
+
+
+class StubProvider:
+    """不連網的假模型：latency_ms ± jitter_ms 的延遲、failure_rate 機率丟 StubUnavailable。"""
+    name = "stub"
+    model_name = "stub"
+
+    def __init__(self, latency_ms=200.0, jitter_ms=50.0, failure_rate=0.0, seed=None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.failure_rate = failure_rate
+        self._rnd = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        seed = os.environ.get("LLM_STUB_SEED")
+        return cls(
+            latency_ms=float(os.environ.get("LLM_STUB_LATENCY_MS", "200")),
+            jitter_ms=float(os.environ.get("LLM_STUB_JITTER_MS", "50")),
+            failure_rate=float(os.environ.get("LLM_STUB_FAILURE_RATE", "0")),
+            seed=int(seed) if seed else None,
+        )
+
+    def available(self):
+        return True
+
+    def _prompt_text(self, contents):
+        if isinstance(contents, (list, tuple)):
+            return "\n".join(c for c in contents if isinstance(c, str))
+        return str(contents)
+
+    def _canned(self, kind, prompt):
+        if kind == "note_summary_batch":
+            # prompt 最後一行是 {"id": 筆記內容} 的 JSON
+            for line in reversed(prompt.strip().split("\n")):
+                if line.startswith("{"):
+                    try:
+                        payload = json.loads(line)
+                    except ValueError:
+                        break
+                    return json.dumps({k: f"• {v.strip()[:40]}" for k, v in payload.items()}, ensure_ascii=False)
+            return "{}"
+        if kind == "note_summary":
+            body = prompt.split("\n", 1)[-1].strip()
+            return "\n".join(f"• {line[:40]}" for line in body.split("\n")[:4] if line.strip()) or "• （stub）"
+        if kind in ("review", "review_reduce"):
+            return _STUB_REVIEW if kind == "review" else "• （stub）濃縮後的重點"
+        if kind == "ocr":
+            return json.dumps([{"course_name": "Stub 課程", "day_of_week": 1, "start_time": "09:10",
+                                "end_time": "11:00", "location": None}], ensure_ascii=False)
+        return "（stub）"
+
+    def generate(self, contents, kind="text", generation_config=None, timeout=None):
+        with self._lock:
+            delay = max(0.0, self._rnd.gauss(self.latency_ms, self.jitter_ms)) / 1000.0
+            fail = self._rnd.random() < self.failure_rate
+        time.sleep(delay)
+        if fail:
+            raise StubUnavailable("stub: injected failure")
+        prompt = self._prompt_text(contents)
+        text = self._canned(kind, prompt)
+        return LLMResult(text, len(prompt) // 4 + 1, len(text) // 4 + 1)
+
+
+def get_provider(model_name):
+    """依 LLM_PROVIDER 建立 provider（gemini / stub）。"""
+    name = os.environ.get("LLM_PROVIDER", "gemini").strip().lower()
+    if name == "stub":
+        return StubProvider.from_env()
+    if name != "gemini":
+        print(f"[llm] unknown LLM_PROVIDER={name!r}, using gemini")
+    return GeminiProvider(model_name)
@@ -1,23 +1,29 @@
 
 import os
-import feedparser
-import requests
-from bs4 import BeautifulSoup
-from urllib.parse import urljoin
-from datetime import datetime
+import time
+from datetime import datetime, timedelta
 from .db import get_conn
+from .feed_service import fetch_many
+from .keyword_matcher import KeywordMatcher
+from . import news_store
+
+# 所有訂閱者關鍵字的 Aho-Corasick 自動機；crawler 每輪會 sync 一次，
+# add/remove_keyword 則即時增減（跨 worker 的變更靠下一輪 sync 補上）
+_matcher = KeywordMatcher()
 
 def add_keyword(user_id, kw):
     conn = get_conn()
     conn.execute("INSERT INTO keywords(user_id, keyword) VALUES (?,?)", (user_id, kw))
     conn.commit()
     conn.close()
+    _matcher.add(kw, user_id)
 
 def remove_keyword(user_id, kw):
     conn = get_conn()
     conn.execute("DELETE FROM keywords WHERE user_id=? AND keyword=?", (user_id, kw))
     conn.commit()
     conn.close()
+    _matcher.remove(kw, user_id)
 
 def list_keywords(user_id):
     conn = get_conn()
@@ -25,46 +31,169 @@ def list_keywords(user_id):
     conn.close()
     return [r['keyword'] for r in rows]
 
-def _already_sent(url):
+def already_sent(pairs):
+    """批次檢查 (user_id, url) 是否已推播過，回傳已送出的 pair set（每 400 組一次查詢）。"""
+    pairs = list(dict.fromkeys(pairs))
+    sent = set()
+    if not pairs:
+        return sent
+    conn = get_conn()
+    for i in range(0, len(pairs), 400):
+        chunk = pairs[i:i + 400]
+        params = [v for pair in chunk for v in pair]
+        rows = conn.execute(
+            f"SELECT user_id, url FROM news_deliveries WHERE (user_id, url) IN (VALUES {','.join('(?,?)' for _ in chunk)})",
+            params,
+        ).fetchall()
+        sent.update((r['user_id'], r['url']) for r in rows)
+    conn.close()
+    return sent
+
+def record_sent(deliveries):
+    """把 [(user_id, title, url), ...] 記進每位使用者的推播紀錄（單一 transaction）。"""
+    ts = datetime.now().isoformat(timespec='seconds')
+    rows = [(user_id, url, title, ts) for user_id, title, url in deliveries if url]
+    if not rows:
+        return 0
     conn = get_conn()
-    row = conn.execute("SELECT id FROM news_cache WHERE url=?", (url,)).fetchone()
+    conn.executemany(
+        "INSERT OR IGNORE INTO news_deliveries(user_id, url, title, sent_at) VALUES (?,?,?,?)", rows
+    )
+    conn.commit()
     conn.close()
-    return bool(row)
+    return len(rows)
 
-def _mark_sent(url, title):
+def _prune_deliveries(days=None):
+    days = DELIVERY_DAYS if days is None else days
+    cutoff = (datetime.now() - timedelta(days=days)).isoformat(timespec='seconds')
     conn = get_conn()
-    conn.execute("INSERT OR IGNORE INTO news_cache(url, title, ts) VALUES (?,?,?)", (url, title, datetime.now().isoformat(timespec='seconds')))
+    cur = conn.execute("DELETE FROM news_deliveries WHERE sent_at < ?", (cutoff,))
+    deleted = cur.rowcount
     conn.commit()
     conn.close()
+    return deleted
+
+def _default_feeds():
+    feeds = os.environ.get("NEWS_FEEDS", "").split(",")
+    return [f.strip() for f in feeds if f.strip()]
 
-def crawl_and_filter(keywords, feeds=None, include_sent=False):
+def crawl_and_filter(keywords, feeds=None, include_sent=False, user_id=None):
+    """比對來源與關鍵字；有 user_id 且 include_sent=False 時排除該使用者已收過的項目。"""
     if feeds is None:
-        feeds = os.environ.get("NEWS_FEEDS", "").split(",")
-        feeds = [f.strip() for f in feeds if f.strip()]
+        feeds = _default_feeds()
+    matcher = KeywordMatcher.from_keywords(keywords)
     results = []
+    seen = set()
+    fetched = fetch_many(feeds)
     for f in feeds:
-        try:
-            d = feedparser.parse(f)
-            entries = list(d.entries[:50])
-            # 若 feedparser 沒抓到，嘗試簡單 HTML 解析
-            if not entries:
-                entries = _scrape_html_links(f, limit=200)
-            for e in entries:
-                title = e.get('title','')
-                summary = e.get('summary','') or e.get('desc','')
-                url = e.get('link','') or e.get('url','')
-                text = f"{title} {summary}".lower()
-                if any(kw.lower() in text for kw in keywords):
-                    if not url:
-                        continue
-                    if include_sent or not _already_sent(url):
-                        results.append((title, url))
-        except Exception:
-            continue
-    return results
+        for e in fetched.get(f, []):
+            url = e['link']
+            if not url or url in seen:
+                continue
+            if matcher.match(f"{e['title']} {e['summary']}"):
+                seen.add(url)
+                results.append((e['title'], url))
+    if include_sent or user_id is None:
+        return results
+    sent = already_sent((user_id, url) for _, url in results)
+    return [(title, url) for title, url in results if (user_id, url) not in sent]
 
-def record_sent(url, title):
-    _mark_sent(url, title)
+# 最近一次 crawl_for_subscribers 的統計（每個行程各自一份）
+last_cycle_stats = {}
+# 背景 crawler 不趕時間，等久一點讓慢的來源也能抓完
+CRAWL_DEADLINE = float(os.environ.get("NEWS_CRAWL_DEADLINE", "120"))
+# news_deliveries 保留天數；來源通常不會再出現這麼舊的項目
+DELIVERY_DAYS = int(os.environ.get("NEWS_DELIVERY_DAYS", "60"))
+
+def _subscriptions():
+    """回傳 (user → keywords, feed url → 訂閱的 user set)；沒有自訂來源的用 NEWS_FEEDS。"""
+    conn = get_conn()
+    kw_rows = conn.execute(
+        "SELECT k.user_id, k.keyword FROM keywords k JOIN users u ON u.user_id = k.user_id ORDER BY k.id DESC"
+    ).fetchall()
+    feed_rows = conn.execute("SELECT user_id, url FROM feeds ORDER BY id DESC").fetchall()
+    conn.close()
+    user_kws = {}
+    for r in kw_rows:
+        kw = (r['keyword'] or '').strip()
+        if kw:
+            user_kws.setdefault(r['user_id'], []).append(kw)
+    user_feeds = {}
+    for r in feed_rows:
+        if r['user_id'] in user_kws and (r['url'] or '').strip():
+            user_feeds.setdefault(r['user_id'], []).append(r['url'].strip())
+    defaults = _default_feeds()
+    feed_subs = {}
+    for user_id in user_kws:
+        for url in user_feeds.get(user_id) or defaults:
+            feed_subs.setdefault(url, set()).add(user_id)
+    return user_kws, feed_subs
+
+def _all_feeds():
+    """所有使用者設定過的來源 + NEWS_FEEDS（news store 要維持這些來源的索引）。"""
+    conn = get_conn()
+    rows = conn.execute("SELECT DISTINCT url FROM feeds").fetchall()
+    conn.close()
+    urls = [(r['url'] or '').strip() for r in rows]
+    return [u for u in urls if u] + _default_feeds()
+
+def crawl_for_subscribers():
+    """每個 crawl cycle 每個來源只抓一次，再對所有訂閱者的關鍵字比對。
+
+    回傳 ({user_id: [(title, url), ...]}, stats)。
+    """
+    started = time.perf_counter()
+    user_kws, feed_subs = _subscriptions()
+    _matcher.sync(user_kws)
+    all_feeds = list(dict.fromkeys(list(feed_subs) + _all_feeds()))
+    stats = {"subscribers": len(user_kws), "feeds": len(all_feeds), "keywords": len(_matcher),
+             "fetches": 0, "fetch_errors": 0, "entries": 0, "indexed": 0, "matches": 0}
+    results = {}
+    seen = {}
+    fetched = fetch_many(all_feeds, deadline=CRAWL_DEADLINE)
+    for feed_url in all_feeds:
+        entries = fetched.get(feed_url)
+        if entries is None:
+            stats["fetch_errors"] += 1
+            continue
+        stats["fetches"] += 1
+        stats["entries"] += len(entries)
+        # 順便更新本地 news store（/web/news 搜尋用）
+        stats["indexed"] += news_store.index_entries(entries)
+        subscribers = feed_subs.get(feed_url)
+        if not subscribers:
+            continue
+        for e in entries:
+            url = e['link']
+            if not url:
+                continue
+            # 一次掃描得到所有命中的訂閱者，再限縮到訂閱此來源的人
+            for user_id in _matcher.match_users(f"{e['title']} {e['summary']}"):
+                if user_id not in subscribers:
+                    continue
+                user_seen = seen.setdefault(user_id, set())
+                if url in user_seen:
+                    continue
+                user_seen.add(url)
+                results.setdefault(user_id, []).append((e['title'], url))
+    # 所有候選 (user, url) 一次批次比對推播紀錄
+    sent = already_sent((user_id, url) for user_id, items in results.items() for _, url in items)
+    for user_id in list(results):
+        items = [(title, url) for title, url in results[user_id] if (user_id, url) not in sent]
+        if items:
+            results[user_id] = items
+        else:
+            del results[user_id]
+    stats["already_sent"] = len(sent)
+    stats["matches"] = sum(len(items) for items in results.values())
+    stats["pruned"] = news_store.prune()
+    stats["pruned_deliveries"] = _prune_deliveries()
+    stats["duration_ms"] = round((time.perf_counter() - started) * 1000.0, 1)
+    stats["finished_at"] = datetime.now().isoformat(timespec='seconds')
+    last_cycle_stats.clear()
+    last_cycle_stats.update(stats)
+    print(f"[news] crawl cycle: {stats}")
+    return results, stats
 
 def add_feed(user_id, url):
     conn = get_conn()
@@ -88,65 +217,19 @@ def get_feeds_for_user(user_id):
     user_feeds = list_feeds(user_id)
     if user_feeds:
         return user_feeds
-    feeds = os.environ.get("NEWS_FEEDS", "").split(",")
-    return [f.strip() for f in feeds if f.strip()]
+    return _default_feeds()
 
-def _scrape_html_links(feed_url, limit=30):
-    """Fallback：對非 RSS 頁面簡單抓取 <a> 連結作為項目。"""
-    try:
-        resp = requests.get(feed_url, timeout=8)
-        resp.raise_for_status()
-        soup = BeautifulSoup(resp.text, "html.parser")
-        links = []
-        for a in soup.find_all("a"):
-            title = (a.get_text() or "").strip()
-            href = a.get("href")
-            if not title or not href:
-                continue
-            if href.startswith("#"):
-                continue
-            if len(title) < 4:
-                continue
-            links.append({
-                "title": title,
-                "summary": "",
-                "link": urljoin(feed_url, href),
-                "feed": feed_url,
-            })
-            if len(links) >= limit:
-                break
-        return links
-    except Exception:
-        return []
-
-def search_news(user_id, query: str, limit_per_feed: int = 15):
-    """即時從使用者的來源抓資料並搜尋 query（標題+摘要）。"""
+def search_news(user_id, query: str, page: int = 1, per_page: int = 20, since=None, until=None):
+    """在使用者來源的本地 news store 中搜尋 query，回傳 (results, total)。
+
+    store 由背景 crawler 維持；尚未收錄過的來源（例如剛新增的）會先抓一次再查。
+    """
     feeds = get_feeds_for_user(user_id)
     if not feeds or not query:
-        return []
-    q = query.lower()
-    matches = []
-    for f in feeds:
-        try:
-            d = feedparser.parse(f)
-            entries = list(d.entries[: max(limit_per_feed, 50)])
-            if not entries:
-                entries = _scrape_html_links(f, limit=200)
-            for e in entries:
-                title = e.get("title", "")
-                summary = e.get("summary", "") or e.get("desc","")
-                url = e.get("link", "") or e.get("url","")
-                text = f"{title} {summary}".lower()
-                if q in text:
-                    matches.append(
-                        {
-                            "title": title,
-                            "summary": summary,
-                            "url": url,
-                            "feed": f,
-                            "published": e.get("published", "") or "",
-                        }
-                    )
-        except Exception:
-            continue
-    return matches
+        return [], 0
+    indexed = news_store.indexed_feeds(feeds)
+    missing = [f for f in feeds if f not in indexed]
+    if missing:
+        for entries in fetch_many(missing).values():
+            news_store.index_entries(entries)
+    return news_store.search(feeds, query, page=page, per_page=per_page, since=since, until=until)
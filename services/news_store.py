@@ -0,0 +1,205 @@
+"""Local news item store with an inverted index.
+
+背景 crawler 抓到的項目寫進 news_items，並把標題 / 摘要切成詞寫進 news_terms：
+- 英文與數字：以單字為 token；
+- CJK：同時存 unigram 與 bigram（查詢時多字用 bigram、單字用 unigram）。
+/web/news 的搜尋只查本地索引（AND 語意、TF-IDF 排序、日期篩選、分頁），不再即時爬所有來源；
+英數查詢詞以前綴比對（learn 也找得到 learning），與舊版子字串搜尋的行為接近。
+同一個 URL 出現在多個來源時每個來源各存一份（(feed, url) 唯一）。
+"""
+import math
+import os
+import re
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+
+from .db import get_conn
+from .keyword_matcher import normalize
+
+STORE_DAYS = int(os.environ.get("NEWS_STORE_DAYS", "30"))
+TITLE_WEIGHT = 3.0
+_MAX_SQL_VARS = 500
+
+_CJK = "㐀-䶿一-鿿豈-﫿぀-ヿ가-힯"
+_TOKEN_RE = re.compile(f"([{_CJK}]+)|([^\\W_{_CJK}]+)")
+
+
+def _terms(text):
+    """把文字切成 index term：英數詞整個一個，CJK 取單字與 bigram（查詢詞見 _query_ranges）。"""
+    out = []
+    for cjk, word in _TOKEN_RE.findall(normalize(text)):
+        if word:
+            out.append(word)
+            continue
+        out.extend(cjk)
+        out.extend(cjk[i:i + 2] for i in range(len(cjk) - 1))
+    return out
+
+
+def _query_ranges(query):
+    """查詢詞 → [(lo, hi)]，以 lo <= term < hi 比對 index term。
+
+    英數詞（兩個字元以上）取前綴範圍；CJK bigram / 單字只比對完全相同的 term。
+    """
+    out = []
+    for cjk, word in _TOKEN_RE.findall(normalize(query)):
+        if word:
+            if len(word) >= 2:
+                out.append((word, word[:-1] + chr(ord(word[-1]) + 1)))
+            else:
+                out.append((word, word + "\0"))
+            continue
+        bigrams = [cjk[i:i + 2] for i in range(len(cjk) - 1)]
+        out.extend((t, t + "\0") for t in bigrams or [cjk])
+    return list(dict.fromkeys(out))
+
+
+def _day(value, name):
+    """'YYYY-MM-DD' → datetime；格式錯誤丟 ValueError。"""
+    try:
+        return datetime.strptime(value, "%Y-%m-%d")
+    except (TypeError, ValueError):
+        raise ValueError(f"invalid {name} date: {value!r}")
+
+
+def _published_at(entry, fallback):
+    raw = (entry.get("published") or "").strip()
+    if raw:
+        for parse in (parsedate_to_datetime, datetime.fromisoformat):
+            try:
+                dt = parse(raw)
+            except Exception:
+                continue
+            if dt.tzinfo is not None:
+                dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+            return dt.isoformat(timespec="seconds")
+    return fallback
+
+
+def index_entries(entries):
+    """把 feed_service 格式的項目寫入 store；同一來源已存在的 URL 略過。回傳新增筆數。"""
+    now = datetime.utcnow().isoformat(timespec="seconds")
+    conn = get_conn()
+    added = 0
+    for e in entries:
+        url = e.get("link")
+        if not url:
+            continue
+        cur = conn.execute(
+            """INSERT OR IGNORE INTO news_items(url, feed, title, summary, published, published_at, indexed_at)
+               VALUES (?,?,?,?,?,?,?)""",
+            (url, e.get("feed"), e.get("title", ""), e.get("summary", ""), e.get("published", ""),
+             _published_at(e, now), now),
+        )
+        if not cur.rowcount:
+            continue
+        item_id = cur.lastrowid
+        weights = {}
+        for term in _terms(e.get("title", "")):
+            weights[term] = weights.get(term, 0.0) + TITLE_WEIGHT
+        for term in _terms(e.get("summary", "")):
+            weights[term] = weights.get(term, 0.0) + 1.0
+        conn.executemany(
+            "INSERT OR IGNORE INTO news_terms(term, item_id, weight) VALUES (?,?,?)",
+            [(t, item_id, w) for t, w in weights.items()],
+        )
+        added += 1
+    conn.commit()
+    conn.close()
+    return added
+
+
+def indexed_feeds(feeds):
+    """回傳 feeds 中已經有項目在 store 裡的來源。"""
+    feeds = list(feeds)
+    if not feeds:
+        return set()
+    conn = get_conn()
+    found = set()
+    for i in range(0, len(feeds), _MAX_SQL_VARS):
+        chunk = feeds[i:i + _MAX_SQL_VARS]
+        rows = conn.execute(
+            f"SELECT DISTINCT feed FROM news_items WHERE feed IN ({','.join('?' * len(chunk))})", chunk
+        ).fetchall()
+        found.update(r[0] for r in rows)
+    conn.close()
+    return found
+
+
+def search(feeds, query, page=1, per_page=20, since=None, until=None):
+    """在指定來源的項目中搜尋 query（所有詞都要出現），回傳 (results, total)。
+
+    ``since`` / ``until`` 為 'YYYY-MM-DD'（含 since、不含 until 的隔天以前），格式錯誤丟 ValueError。
+    """
+    where = []
+    date_params = []
+    if since:
+        where.append("i.published_at >= ?")
+        date_params.append(_day(since, "since").strftime("%Y-%m-%d"))
+    if until:
+        where.append("i.published_at < ?")
+        date_params.append((_day(until, "until") + timedelta(days=1)).strftime("%Y-%m-%d"))
+    feeds = list(feeds)[:_MAX_SQL_VARS]
+    ranges = _query_ranges(query)[:20]
+    if not feeds or not ranges:
+        return [], 0
+    conn = get_conn()
+    n_items = conn.execute("SELECT COUNT(*) FROM news_items").fetchone()[0] or 1
+    idf = []
+    for lo, hi in ranges:
+        # (term, item_id) 是 PK，前綴範圍也是 index range scan
+        df = conn.execute(
+            "SELECT COUNT(DISTINCT item_id) FROM news_terms WHERE term >= ? AND term < ?", (lo, hi)
+        ).fetchone()[0]
+        if not df:
+            conn.close()
+            return [], 0
+        idf.append(math.log(1 + n_items / df))
+
+    values = ",".join("(?,?,?,?)" for _ in ranges)
+    params = []
+    for qid, ((lo, hi), w) in enumerate(zip(ranges, idf)):
+        params.extend([qid, lo, hi, w])
+    where.insert(0, f"i.feed IN ({','.join('?' * len(feeds))})")
+    params.extend(feeds)
+    params.extend(date_params)
+    params.append(len(ranges))
+    matched = f"""WITH q(qid, lo, hi, idf) AS (VALUES {values})
+            SELECT i.id, i.title, i.summary, i.url, i.feed, i.published, i.published_at,
+                   SUM(t.weight * q.idf) AS score
+            FROM q
+            JOIN news_terms t ON t.term >= q.lo AND t.term < q.hi
+            JOIN news_items i ON i.id = t.item_id
+            WHERE {' AND '.join(where)}
+            GROUP BY i.id
+            HAVING COUNT(DISTINCT q.qid) = ?"""
+    total = conn.execute(f"SELECT COUNT(*) FROM ({matched})", params).fetchone()[0]
+    page = max(1, int(page))
+    rows = []
+    if total > (page - 1) * per_page:
+        rows = conn.execute(
+            f"{matched} ORDER BY score DESC, i.published_at DESC LIMIT ? OFFSET ?",
+            params + [per_page, (page - 1) * per_page],
+        ).fetchall()
+    conn.close()
+    results = []
+    for r in rows:
+        d = dict(r)
+        d.pop("id", None)
+        d["score"] = round(d["score"], 3)
+        results.append(d)
+    return results, total
+
+
+def prune(days=STORE_DAYS):
+    """刪除超過 ``days`` 天前收錄的項目與其索引。"""
+    cutoff = (datetime.utcnow() - timedelta(days=days)).isoformat(timespec="seconds")
+    conn = get_conn()
+    conn.execute(
+        "DELETE FROM news_terms WHERE item_id IN (SELECT id FROM news_items WHERE indexed_at < ?)", (cutoff,)
+    )
+    cur = conn.execute("DELETE FROM news_items WHERE indexed_at < ?", (cutoff,))
+    deleted = cur.rowcount
+    conn.commit()
+    conn.close()
+    return deleted
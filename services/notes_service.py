@@ -1,32 +1,74 @@
 
 import os
-from datetime import datetime
+import time
+from datetime import datetime, timedelta
 from .db import get_conn
-from .summarize_service import summarize_note
+from .summarize_service import needs_llm, summarize_note, summarize_notes
+from . import summary_worker
 
-def add_note(user_id, content, course_name=None):
+# 搶到的筆記超過這個時間還沒寫回摘要（例如 worker 被砍），其他人可以再搶
+SUMMARY_CLAIM_MINUTES = int(os.environ.get("SUMMARY_CLAIM_MINUTES", "10"))
+
+def add_note(user_id, content, course_name=None, notify=False):
+    """存檔並回傳 (note id, summary)。
+
+    不需要 LLM 的短筆記當場做抽取式摘要（幾毫秒）一起存進去；要走 LLM 的存成
+    summary_status='pending'，summary 回傳 None，由背景 worker 產生（notify 時完成後推播）。
+    """
     ts = datetime.now().isoformat(timespec='seconds')
-    summary = summarize_note(content) or None
+    summary, status = None, 'pending'
+    if not needs_llm(content):
+        summary = summarize_note(content) or None
+        status = 'done' if summary else 'failed'
     conn = get_conn()
-    conn.execute(
-        "INSERT INTO notes(user_id, course_name, ts, content, summary) VALUES (?,?,?,?,?)",
-        (user_id, course_name, ts, content, summary),
+    cur = conn.execute(
+        "INSERT INTO notes(user_id, course_name, ts, content, summary, summary_status) VALUES (?,?,?,?,?,?)",
+        (user_id, course_name, ts, content, summary, status),
     )
+    note_id = cur.lastrowid
+    _mark_reviews_stale(conn, user_id)
     conn.commit()
     conn.close()
-    return summary
+    if status == 'pending':
+        summary_worker.enqueue(note_id, notify=notify)
+    return note_id, summary
+
+def _mark_reviews_stale(conn, *user_ids):
+    """筆記增刪或摘要寫入後讓這些使用者的回顧包快取在下次讀取時重新比對指紋（不另外 commit）。"""
+    conn.executemany("UPDATE review_cache SET stale=1 WHERE user_id=? AND stale=0",
+                     [(u,) for u in dict.fromkeys(user_ids)])
 
 def get_notes_for_date(user_id, date_obj):
     date_str = date_obj.strftime('%Y-%m-%d')
+    next_str = (date_obj + timedelta(days=1)).strftime('%Y-%m-%d')
     conn = get_conn()
+    # 用區間比較而非 LIKE，才能走 (user_id, ts) 索引
     rows = conn.execute(
-        "SELECT * FROM notes WHERE user_id=? AND ts LIKE ? ORDER BY ts DESC",
-        (user_id, date_str + '%')
+        "SELECT * FROM notes WHERE user_id=? AND ts >= ? AND ts < ? ORDER BY ts DESC",
+        (user_id, date_str, next_str)
     ).fetchall()
     result = [dict(r) for r in rows]
     conn.close()
     return result
 
+def get_notes_in_range(user_id, start, end):
+    """[start, end) 區間內的筆記（依時間先後），週/月回顧包用。"""
+    conn = get_conn()
+    rows = conn.execute(
+        "SELECT * FROM notes WHERE user_id=? AND ts >= ? AND ts < ? ORDER BY ts",
+        (user_id, start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')),
+    ).fetchall()
+    conn.close()
+    return [dict(r) for r in rows]
+
+def get_notes_for_course(user_id, course_name):
+    conn = get_conn()
+    rows = conn.execute(
+        "SELECT * FROM notes WHERE user_id=? AND course_name=? ORDER BY ts", (user_id, course_name)
+    ).fetchall()
+    conn.close()
+    return [dict(r) for r in rows]
+
 def list_notes(user_id, limit=50):
     conn = get_conn()
     rows = conn.execute("SELECT * FROM notes WHERE user_id=? ORDER BY ts DESC LIMIT ?", (user_id, limit)).fetchall()
@@ -48,46 +90,84 @@ def regenerate_note_summary(user_id, note_id, new_summary=None):
         return None
     summary = new_summary or summarize_note(row["content"]) or None
     if summary:
-        conn.execute("UPDATE notes SET summary=? WHERE id=?", (summary, note_id))
+        conn.execute("UPDATE notes SET summary=?, summary_status='done' WHERE id=?", (summary, note_id))
+        _mark_reviews_stale(conn, user_id)
         conn.commit()
     updated = conn.execute("SELECT * FROM notes WHERE id=?", (note_id,)).fetchone()
     conn.close()
     return dict(updated) if updated else None
 
-def ensure_summaries(user_id, limit=20):
-    """Backfill summaries for this user（有 LLM 用 LLM，沒有就用 rule-based）。"""
+def _store_summaries(rows):
+    """對 rows（需有 id、user_id、content）批次產生摘要並一次寫回，回傳成功筆數。"""
+    if not rows:
+        return 0
+    summaries = summarize_notes([r["content"] for r in rows])
+    updates = [(s, "done" if s else "failed", r["id"]) for r, s in zip(rows, summaries)]
     conn = get_conn()
-    rows = conn.execute(
-        "SELECT id, content FROM notes WHERE user_id=? AND (summary IS NULL OR summary='') ORDER BY ts DESC LIMIT ?",
-        (user_id, limit),
-    ).fetchall()
-    updated = 0
-    for r in rows:
-        s = summarize_note(r["content"])
-        if not s:
-            continue
-        conn.execute("UPDATE notes SET summary=? WHERE id=?", (s, r["id"]))
-        updated += 1
-    if updated:
-        conn.commit()
+    conn.executemany("UPDATE notes SET summary=?, summary_status=? WHERE id=?", updates)
+    _mark_reviews_stale(conn, *(r["user_id"] for r, s in zip(rows, summaries) if s))
+    conn.commit()
     conn.close()
-    return updated
+    return sum(1 for s, _, _ in updates if s)
+
+def claim_for_summary(note_ids):
+    """搶下還沒有摘要、也沒有別人正在產生（或已逾時）的筆記，回傳這次搶到的 id。
 
-def ensure_summaries_for_all(limit_per_user=200):
-    """Backfill summaries for every user in notes table."""
+    summary_worker、排程 backfill 與 backfill CLI 產生摘要前都先呼叫，同一則筆記不會被做兩次。
+    """
+    ids = list(note_ids)
+    if not ids:
+        return []
+    now = time.time()
+    stale = now - SUMMARY_CLAIM_MINUTES * 60
+    claimed = []
     conn = get_conn()
-    users = [r[0] for r in conn.execute("SELECT DISTINCT user_id FROM notes").fetchall()]
+    if not conn.in_transaction:
+        conn.execute("BEGIN IMMEDIATE")
+    try:
+        for i in range(0, len(ids), 400):
+            chunk = ids[i:i + 400]
+            marks = ",".join("?" * len(chunk))
+            conn.execute(
+                f"""UPDATE notes SET summary_claimed_at=?
+                    WHERE id IN ({marks}) AND (summary IS NULL OR summary='')
+                      AND (summary_claimed_at IS NULL OR summary_claimed_at < ?)""",
+                [now, *chunk, stale],
+            )
+            claimed += [r[0] for r in conn.execute(
+                f"SELECT id FROM notes WHERE id IN ({marks}) AND summary_claimed_at=?", [*chunk, now]
+            )]
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return claimed
+
+def backfill_pending(budget=20, min_age_minutes=2):
+    """補齊 summary_status='pending' 的筆記，每次最多 budget 筆（由背景排程呼叫）。
+
+    剛新增的筆記通常還在 summary_worker 的佇列裡，先跳過 min_age_minutes 內的；
+    其餘的先 claim_for_summary，worker 已經在做的不會再做一次。
+    """
+    cutoff = (datetime.now() - timedelta(minutes=min_age_minutes)).isoformat(timespec='seconds')
+    conn = get_conn()
+    rows = conn.execute(
+        "SELECT id, user_id, content FROM notes WHERE summary_status='pending' AND ts < ? ORDER BY id LIMIT ?",
+        (cutoff, int(budget)),
+    ).fetchall()
     conn.close()
-    total = 0
-    for u in users:
-        total += ensure_summaries(u, limit=limit_per_user)
-    return total
+    claimed = set(claim_for_summary(r["id"] for r in rows))
+    return _store_summaries([r for r in rows if r["id"] in claimed])
 
 def delete_note(user_id, note_id):
     conn = get_conn()
     cur = conn.cursor()
     cur.execute("DELETE FROM notes WHERE id=? AND user_id=?", (note_id, user_id))
     deleted = cur.rowcount
+    if deleted:
+        _mark_reviews_stale(conn, user_id)
     conn.commit()
     conn.close()
     return deleted
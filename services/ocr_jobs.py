@@ -0,0 +1,322 @@
+"""Background schedule-image OCR import jobs.
+
+LINE「完成」與網站上傳圖片不再在 request 裡等 Gemini：
+- submit 把圖片放進 OCR_JOB_DIR 下這個工作專屬的目錄，在 ocr_jobs 記一筆 queued 就回傳
+- worker pool 以 UPDATE ... WHERE status='queued' 搶工作（多個 worker 也只會跑一次），
+  辨識 + 匯入課表後把結果寫回 result_json，並呼叫 notifier（LINE 推播）；網站端輪詢 get_job
+- 每筆工作記錄持有的行程（owner = host:pid）；行程已不在或逾時的 queued / running 工作
+  由排程的 recover_stale 重新排入，還在別的 worker 佇列裡的不會重複排
+- 失敗的工作在次數用完前保留圖片，之後還能重試
+"""
+import json
+import os
+import pathlib
+import shutil
+import socket
+import threading
+import time
+import uuid
+
+from . import db, ocr_service, schedule_service
+from .background import BackgroundPool
+from .db import get_conn
+
+OCR_JOB_WORKERS = int(os.environ.get("OCR_JOB_WORKERS", "2"))
+# 持有者超過這個時間沒有進度視為卡住，重新排入（最多 OCR_JOB_MAX_ATTEMPTS 次）
+OCR_JOB_TIMEOUT_MINUTES = int(os.environ.get("OCR_JOB_TIMEOUT_MINUTES", "10"))
+OCR_JOB_MAX_ATTEMPTS = int(os.environ.get("OCR_JOB_MAX_ATTEMPTS", "3"))
+OCR_JOB_KEEP_DAYS = int(os.environ.get("OCR_JOB_KEEP_DAYS", "7"))
+
+pool = BackgroundPool("ocr-import", OCR_JOB_WORKERS)
+_notifier = None
+_stats_lock = threading.Lock()
+_stats = {"submitted": 0, "done": 0, "failed": 0, "requeued": 0}
+
+
+def _count(key):
+    with _stats_lock:
+        _stats[key] += 1
+
+
+def set_notifier(fn):
+    """註冊 fn(job_dict)，工作結束（done 或 failed）時呼叫。"""
+    global _notifier
+    _notifier = fn
+
+
+def _owner():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _owner_alive(owner):
+    """owner 行程是否還活著；別台機器的無法判斷，回傳 None。"""
+    host, _, pid = (owner or "").rpartition(":")
+    if not owner or not pid.isdigit():
+        return False
+    if host != socket.gethostname():
+        return None
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True
+    return True
+
+
+def _job_root():
+    path = os.environ.get("OCR_JOB_DIR") or str(pathlib.Path(db.DB_PATH).resolve().parent / "ocr_jobs")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _remove_dir(path):
+    try:
+        shutil.rmtree(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        print(f"[ocr-import] remove {path} failed: {e!r}")
+
+
+def submit(user_id, images=None, paths=None, refresh=False, source="web"):
+    """建立 OCR 匯入工作並排入背景，回傳 job id。
+
+    images 是 bytes 的 list（網站上傳）；paths 是 upload_store.take_images 交出來的檔案，
+    會直接搬進工作目錄（不再讀進記憶體）。
+    """
+    image_dir = os.path.join(_job_root(), uuid.uuid4().hex)
+    os.makedirs(image_dir)
+    n = 0
+    try:
+        for b in images or []:
+            with open(os.path.join(image_dir, f"{n:03d}.img"), "wb") as f:
+                f.write(b)
+            n += 1
+        for p in paths or []:
+            try:
+                shutil.move(p, os.path.join(image_dir, f"{n:03d}.img"))
+                n += 1
+            except OSError as e:
+                print(f"[ocr-import] move {p} failed: {e!r}")
+    except BaseException:
+        _remove_dir(image_dir)
+        raise
+
+    now = time.time()
+    conn = get_conn()
+    with conn:
+        cur = conn.execute(
+            "INSERT INTO ocr_jobs(user_id, source, refresh, image_dir, n_images, created_at, owner, heartbeat_at) "
+            "VALUES (?,?,?,?,?,?,?,?)",
+            (user_id, source, 1 if refresh else 0, image_dir, n, now, _owner(), now),
+        )
+        job_id = cur.lastrowid
+    conn.close()
+    _count("submitted")
+    pool.submit(run_job, job_id)
+    return job_id
+
+
+def _load_images(image_dir):
+    images = []
+    try:
+        names = sorted(os.listdir(image_dir))
+    except OSError:
+        return images
+    for name in names:
+        try:
+            with open(os.path.join(image_dir, name), "rb") as f:
+                images.append(f.read())
+        except OSError as e:
+            print(f"[ocr-import] read {name} failed: {e!r}")
+    return images
+
+
+def import_courses(user_id, courses):
+    """把辨識出的課程加進課表，回傳 (成功筆數, 失敗訊息 list)；缺課名或時間的略過。"""
+    rows = [{k: v for k, v in c.items() if k != "user_id"} for c in courses or []
+            if isinstance(c, dict) and c.get("course_name") and c.get("start_time")]
+    results = schedule_service.add_courses(user_id, rows)
+    fail_msgs = [f"• {r['course_name']}: {r['error']}" for r in results if not r["ok"]]
+    return len(results) - len(fail_msgs), fail_msgs
+
+
+def _finish(job_id, status, result=None, error=None):
+    """寫回結果；工作已被 recover_stale 轉給別的行程時不覆蓋，回傳是否寫入。"""
+    conn = get_conn()
+    with conn:
+        updated = conn.execute(
+            "UPDATE ocr_jobs SET status=?, result_json=?, error=?, finished_at=? "
+            "WHERE id=? AND status='running' AND owner=?",
+            (status, json.dumps(result, ensure_ascii=False) if result is not None else None, error,
+             time.time(), job_id, _owner()),
+        ).rowcount
+    conn.close()
+    return bool(updated)
+
+
+def _retry_later(job_id, error):
+    """暫時性失敗：改回 queued 並放掉 owner，下一輪 recover_stale 重新排入（圖片保留）。"""
+    conn = get_conn()
+    with conn:
+        conn.execute(
+            "UPDATE ocr_jobs SET status='queued', owner=NULL, error=?, heartbeat_at=? "
+            "WHERE id=? AND status='running' AND owner=?",
+            (error, time.time(), job_id, _owner()),
+        )
+    conn.close()
+
+
+def run_job(job_id):
+    """搶到 queued 的工作就辨識並匯入；已被別的 worker 拿走或不存在時直接回傳 None。"""
+    conn = get_conn()
+    with conn:
+        now = time.time()
+        claimed = conn.execute(
+            "UPDATE ocr_jobs SET status='running', owner=?, started_at=?, heartbeat_at=?, attempts=attempts+1 "
+            "WHERE id=? AND status='queued'",
+            (_owner(), now, now, job_id),
+        ).rowcount
+    row = conn.execute("SELECT * FROM ocr_jobs WHERE id=?", (job_id,)).fetchone() if claimed else None
+    conn.close()
+    if not row:
+        return None
+
+    images = _load_images(row["image_dir"])
+    if not images:
+        finished = _finish(job_id, "failed", error="找不到上傳的圖片，請重新上傳。")
+        _count("failed")
+    else:
+        try:
+            courses, from_cache = ocr_service.parse_schedule_cached(images, refresh=bool(row["refresh"]))
+            success_count, fail_msgs = import_courses(row["user_id"], courses)
+        except Exception as e:
+            print(f"[ocr-import] job {job_id} attempt {row['attempts']} failed: {e!r}")
+            if row["attempts"] < OCR_JOB_MAX_ATTEMPTS:
+                _retry_later(job_id, repr(e))
+                return None
+            finished = _finish(job_id, "failed", error=repr(e))
+            _count("failed")
+        else:
+            result = {"recognized": len(courses or []), "added": success_count,
+                      "failed": fail_msgs, "from_cache": from_cache}
+            finished = _finish(job_id, "done", result=result)
+            _count("done")
+    if not finished:
+        # 已逾時並被轉給別的行程，圖片與通知交給它處理
+        return None
+    _remove_dir(row["image_dir"])
+
+    job = get_job(row["user_id"], job_id)
+    if _notifier and job:
+        try:
+            _notifier(job)
+        except Exception as e:
+            print(f"[ocr-import] notify failed: {e!r}")
+    return job
+
+
+def get_job(user_id, job_id):
+    """回傳這位使用者的工作（result_json 已解開成 result）；不存在或不是他的回傳 None。"""
+    conn = get_conn()
+    row = conn.execute(
+        "SELECT id, user_id, source, status, n_images, result_json, error, created_at, started_at, finished_at "
+        "FROM ocr_jobs WHERE id=? AND user_id=?",
+        (job_id, user_id),
+    ).fetchone()
+    conn.close()
+    if not row:
+        return None
+    job = dict(row)
+    job["result"] = json.loads(job.pop("result_json")) if row["result_json"] else None
+    return job
+
+
+def format_result(job):
+    """把工作結果轉成要回給使用者的文字（LINE 推播與網頁共用）。"""
+    if job["status"] in ("queued", "running"):
+        return f"正在辨識 {job['n_images']} 張圖片，完成後會通知你。"
+    result = job.get("result")
+    if job["status"] != "done" or result is None:
+        return f"課表辨識失敗：{job.get('error') or '未知錯誤'}\n請稍後再試一次。"
+    if not result["recognized"]:
+        return "AI 未能辨識出任何課程，請確認圖片清晰度或格式。"
+    text = f"辨識完成！共加入 {result['added']} 堂課程。"
+    if result["failed"]:
+        text += "\n部分失敗：\n" + "\n".join(result["failed"][:3])
+    if result["from_cache"]:
+        text += "\n（這組圖片先前辨識過，直接使用上次的結果；若有誤請先清空課表，重新上傳後輸入「重新辨識」）"
+    return text
+
+
+def recover_stale(now=None):
+    """重新排入沒人顧的工作，並清掉過期的紀錄；回傳重新排入的數量。
+
+    queued / running 的工作只有在持有的行程已不在（或沒有 owner），或持有者超過
+    OCR_JOB_TIMEOUT_MINUTES 沒有進度時才轉給這個行程重新排入；還在別的 worker 佇列裡的不動。
+    running 逾時且次數用完的標成 failed 並刪掉圖片。
+    """
+    now = now or time.time()
+    cutoff = now - OCR_JOB_TIMEOUT_MINUTES * 60
+    me = _owner()
+    conn = get_conn()
+    rows = conn.execute(
+        "SELECT id, status, owner, heartbeat_at, attempts, image_dir FROM ocr_jobs "
+        "WHERE status IN ('queued','running') ORDER BY id"
+    ).fetchall()
+    conn.close()
+    job_ids = []
+    abandoned = []
+    for r in rows:
+        timed_out = (r["heartbeat_at"] or 0) < cutoff
+        if _owner_alive(r["owner"]) is not False and not timed_out:
+            continue
+        conn = get_conn()
+        with conn:
+            if r["status"] == "running" and r["attempts"] >= OCR_JOB_MAX_ATTEMPTS:
+                moved = conn.execute(
+                    "UPDATE ocr_jobs SET status='failed', error='辨識逾時', finished_at=? "
+                    "WHERE id=? AND status='running' AND owner IS ?",
+                    (now, r["id"], r["owner"]),
+                ).rowcount
+                if moved:
+                    abandoned.append(r["image_dir"])
+                    _count("failed")
+            else:
+                moved = conn.execute(
+                    "UPDATE ocr_jobs SET status='queued', owner=?, heartbeat_at=? "
+                    "WHERE id=? AND status=? AND owner IS ?",
+                    (me, now, r["id"], r["status"], r["owner"]),
+                ).rowcount
+                if moved:
+                    job_ids.append(r["id"])
+        conn.close()
+
+    conn = get_conn()
+    with conn:
+        expired = conn.execute(
+            "SELECT id, image_dir FROM ocr_jobs WHERE status IN ('done','failed') AND finished_at < ?",
+            (now - OCR_JOB_KEEP_DAYS * 86400,),
+        ).fetchall()
+        if expired:
+            conn.executemany("DELETE FROM ocr_jobs WHERE id=?", [(r["id"],) for r in expired])
+    conn.close()
+    for path in abandoned + [r["image_dir"] for r in expired]:
+        _remove_dir(path)
+    for job_id in job_ids:
+        pool.submit(run_job, job_id)
+        _count("requeued")
+    return len(job_ids)
+
+
+def stats():
+    with _stats_lock:
+        out = dict(_stats)
+    conn = get_conn()
+    out["by_status"] = {r["status"]: r["n"] for r in conn.execute(
+        "SELECT status, COUNT(*) AS n FROM ocr_jobs GROUP BY status"
+    )}
+    conn.close()
+    out["pool"] = pool.stats()
+    return out
@@ -1,23 +1,35 @@
+import hashlib
 import io
 import json
 import os
+import threading
+import time
 
-import google.generativeai as genai
-from PIL import Image
+from PIL import Image, ImageChops, ImageOps
 
+from . import llm_client
+from .db import get_conn
 
-def _get_model():
-    """Configure and return the Gemini model; returns None if missing key."""
-    key = os.environ.get("GEMINI_API_KEY")
-    if not key:
-        print("錯誤：找不到 GEMINI_API_KEY")
-        return None
-    genai.configure(api_key=key)
-    return genai.GenerativeModel("gemini-2.5-flash")
+# 送 OCR 前的前處理：縮到這個寬度（手機截圖通常 1080~1440px，課表文字在 ~800px 仍清楚）、
+# 灰階、裁白邊、去掉連續截圖的重疊區，最後以 JPEG 編碼
+OCR_PREPROCESS = os.environ.get("OCR_PREPROCESS", "1") != "0"
+OCR_TARGET_WIDTH = int(os.environ.get("OCR_TARGET_WIDTH", "900"))
+OCR_JPEG_QUALITY = int(os.environ.get("OCR_JPEG_QUALITY", "80"))
+# 重疊偵測：至少要連續這麼多列相同才算重疊；下一張最上面這個比例內的列視為可能的狀態列 / 標題列
+_MIN_OVERLAP_ROWS = 24
+_HEADER_FRACTION = 0.2
+_SIG_COLUMNS = 32
+# 改了 OCR prompt 就要升版，舊的快取自然失效
+OCR_PROMPT_VERSION = "ocr-v1"
+OCR_CACHE = os.environ.get("OCR_CACHE", "1") != "0"
+OCR_CACHE_MAX = int(os.environ.get("OCR_CACHE_MAX", "500"))
+
+_cache_lock = threading.Lock()
+_cache_stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
 
 
 def _stitch_images(image_bytes_list):
-    """Vertically stitch multiple image bytes into one long image."""
+    """Vertically stitch multiple image bytes into one long image (OCR_PREPROCESS=0 的舊路徑，也是 benchmark 基準)."""
     images = []
     try:
         for b in image_bytes_list:
@@ -42,16 +54,202 @@ def _stitch_images(image_bytes_list):
     return new_im
 
 
-def parse_schedule_from_images(image_bytes_list):
-    """Parse schedule entries from a list of image bytes via Gemini OCR."""
-    model = _get_model()
-    if not model or not image_bytes_list:
+def _prepare(b):
+    """解碼一張截圖並縮成 OCR_TARGET_WIDTH 寬的灰階圖；JPEG 用 draft 直接以較小尺寸解碼。"""
+    img = Image.open(io.BytesIO(b))
+    if img.format == "JPEG" and img.width > OCR_TARGET_WIDTH:
+        img.draft("L", (OCR_TARGET_WIDTH, img.height * OCR_TARGET_WIDTH // img.width))
+    img = ImageOps.exif_transpose(img).convert("L")
+    if img.width > OCR_TARGET_WIDTH:
+        img = img.resize((OCR_TARGET_WIDTH, max(1, img.height * OCR_TARGET_WIDTH // img.width)), Image.LANCZOS)
+    return img
+
+
+def _trim(img, threshold=16):
+    """裁掉與左上角背景色相近的四周邊框。"""
+    bg = Image.new("L", img.size, img.getpixel((0, 0)))
+    diff = ImageChops.difference(img, bg).point(lambda p: 255 if p > threshold else 0)
+    box = diff.getbbox()
+    return img.crop(box) if box else img
+
+
+def _row_signatures(img):
+    """每一列縮成 32 格、亮度量化成 8 階的簽章；JPEG 雜訊不會讓相同內容的列比對失敗。"""
+    small = img.resize((_SIG_COLUMNS, img.height), Image.BOX).point(lambda p: p >> 5)
+    data = small.tobytes()
+    return [data[i * _SIG_COLUMNS:(i + 1) * _SIG_COLUMNS] for i in range(img.height)]
+
+
+def _find_overlap(prev_sigs, next_sigs):
+    """找 prev 底部與 next 頂部重疊的區段，回傳 (prev 保留到第幾列, next 從第幾列開始)；沒有重疊回傳 None。"""
+    index = {}
+    for i, sig in enumerate(prev_sigs):
+        if sig != sig[:1] * _SIG_COLUMNS:  # 純色列（空白）不拿來當定位點
+            index.setdefault(sig, []).append(i)
+    n_prev, n_next = len(prev_sigs), len(next_sigs)
+    probe = _MIN_OVERLAP_ROWS - 1
+    best = None
+    for j in range(min(n_next - probe, int(n_next * _HEADER_FRACTION) + 1)):
+        for s in index.get(next_sigs[j], ()):
+            # 先看第 probe 列是否也相同，快速排除表格格線之類重複出現的列
+            if s + probe >= n_prev or prev_sigs[s + probe] != next_sigs[j + probe]:
+                continue
+            run = matched = mismatches = 0
+            while s + run < n_prev and j + run < n_next:
+                if prev_sigs[s + run] != next_sigs[j + run]:
+                    mismatches += 1
+                    if mismatches > max(2, run // 20):
+                        break
+                else:
+                    matched = run + 1  # 重疊只算到最後一列相同的地方，不含尾端的不一致
+                run += 1
+            # 重疊要延伸到 prev 接近底部（允許一小段底部導覽列）
+            if matched >= _MIN_OVERLAP_ROWS and s + matched >= n_prev * (1 - _HEADER_FRACTION):
+                if best is None or matched > best[2]:
+                    best = (s, j, matched)
+        if best:
+            break
+    if not best:
+        return None
+    s, j, run = best
+    return s + run, j + run
+
+
+def preprocess_images(image_bytes_list):
+    """縮圖、灰階、裁邊、去重疊後拼成一張，回傳 (jpeg bytes, info)；沒有可用圖片回傳 (None, info)。"""
+    pieces = []
+    prev_sigs = None
+    info = {"images": len(image_bytes_list), "overlaps": 0, "input_bytes": sum(len(b) for b in image_bytes_list)}
+    for b in image_bytes_list:
+        try:
+            img = _trim(_prepare(b))
+        except Exception as e:
+            print(f"圖片讀取錯誤: {e}")
+            continue
+        sigs = _row_signatures(img)
+        if pieces and prev_sigs is not None and pieces[-1].width == img.width:
+            cut = _find_overlap(prev_sigs, sigs)
+            if cut:
+                keep_prev, start_next = cut
+                pieces[-1] = pieces[-1].crop((0, 0, pieces[-1].width, keep_prev))
+                img = img.crop((0, start_next, img.width, img.height))
+                sigs = sigs[start_next:]
+                info["overlaps"] += 1
+        prev_sigs = sigs
+        if img.height > 0:
+            pieces.append(img)
+    if not pieces:
+        return None, info
+    width = max(p.width for p in pieces)
+    canvas = Image.new("L", (width, sum(p.height for p in pieces)), 255)
+    y = 0
+    for p in pieces:
+        canvas.paste(p, (0, y))
+        y += p.height
+    buf = io.BytesIO()
+    canvas.save(buf, format="JPEG", quality=OCR_JPEG_QUALITY, optimize=True)
+    info.update(width=canvas.width, height=canvas.height, payload_bytes=buf.tell())
+    return buf.getvalue(), info
+
+
+def schedule_cache_key(image_bytes_list):
+    """整組圖片（依順序）的內容雜湊 + prompt / 模型 / 前處理設定。
+
+    刻意不用感知雜湊：同一個選課系統截出來的課表版面幾乎一樣，只差文字，
+    感知雜湊容易把別人的課表當成命中。
+    """
+    h = hashlib.sha256(
+        f"{OCR_PROMPT_VERSION}\0{llm_client.MODEL_NAME}\0{OCR_PREPROCESS}:{OCR_TARGET_WIDTH}:{OCR_JPEG_QUALITY}\0".encode("utf-8")
+    )
+    for b in image_bytes_list:
+        h.update(hashlib.sha256(b).digest())
+    return h.hexdigest()
+
+
+def _count(key, n=1):
+    with _cache_lock:
+        _cache_stats[key] += n
+
+
+def _cache_get(key):
+    conn = get_conn()
+    row = conn.execute("SELECT courses_json FROM ocr_cache WHERE key=?", (key,)).fetchone()
+    if row:
+        conn.execute("UPDATE ocr_cache SET last_used_at=?, hits=hits+1 WHERE key=?", (time.time(), key))
+        conn.commit()
+    conn.close()
+    return json.loads(row["courses_json"]) if row else None
+
+
+def _cache_put(key, courses):
+    now = time.time()
+    conn = get_conn()
+    conn.execute(
+        "INSERT OR REPLACE INTO ocr_cache(key, courses_json, created_at, last_used_at, hits) VALUES (?,?,?,?,0)",
+        (key, json.dumps(courses, ensure_ascii=False), now, now),
+    )
+    excess = conn.execute("SELECT COUNT(*) FROM ocr_cache").fetchone()[0] - OCR_CACHE_MAX
+    if excess > 0:
+        # LRU：淘汰最久沒被用到的
+        conn.execute(
+            "DELETE FROM ocr_cache WHERE key IN (SELECT key FROM ocr_cache ORDER BY last_used_at LIMIT ?)",
+            (excess,),
+        )
+        _count("evictions", excess)
+    conn.commit()
+    conn.close()
+    _count("stores")
+
+
+def cache_stats():
+    with _cache_lock:
+        out = dict(_cache_stats)
+    lookups = out["hits"] + out["misses"]
+    out["hit_rate"] = round(out["hits"] / lookups, 3) if lookups else 0.0
+    out["max_entries"] = OCR_CACHE_MAX
+    out["enabled"] = OCR_CACHE
+    return out
+
+
+def parse_schedule_cached(image_bytes_list, refresh=False):
+    """回傳 (courses, from_cache)。同一組圖片辨識成功過就直接用快取的結果；
+
+    refresh=True 略過快取重新辨識（結果會覆蓋快取），給「辨識結果有誤」時使用。
+    空結果不快取，下次仍會重試。
+    """
+    if not image_bytes_list:
+        return [], False
+    key = schedule_cache_key(image_bytes_list) if OCR_CACHE else None
+    if key and not refresh:
+        cached = _cache_get(key)
+        if cached is not None:
+            _count("hits")
+            return cached, True
+        _count("misses")
+    courses = _parse_schedule(image_bytes_list)
+    if key and isinstance(courses, list) and courses:
+        _cache_put(key, courses)
+    return courses, False
+
+
+def _parse_schedule(image_bytes_list):
+    if not llm_client.available():
+        print("錯誤：找不到 GEMINI_API_KEY")
+        return []
+    if not image_bytes_list:
         return []
 
     try:
-        stitched_image = _stitch_images(image_bytes_list)
-        if not stitched_image:
-            return []
+        if OCR_PREPROCESS:
+            payload, info = preprocess_images(image_bytes_list)
+            if not payload:
+                return []
+            print(f"[ocr] preprocessed {info}")
+            image_part = {"mime_type": "image/jpeg", "data": payload}
+        else:
+            image_part = _stitch_images(image_bytes_list)
+            if not image_part:
+                return []
 
         prompt = """
         請扮演一個課表輸入助理。這是一張由多張截圖拼接而成的長條課表圖片。
@@ -80,8 +278,7 @@ def parse_schedule_from_images(image_bytes_list):
         5. 遇到課程名稱換行的話也請不要在中間加入空格。
         """
 
-        response = model.generate_content([prompt, stitched_image])
-        text = response.text.strip()
+        text = llm_client.generate([prompt, image_part], kind="ocr")
 
         if text.startswith("```json"):
             text = text[7:]
@@ -0,0 +1,162 @@
+"""Set-based class reminders.
+
+一次查詢找出「所有使用者」即將開始的課，取代每 tick 逐一使用者查課表的作法。
+查詢走 schedule(day_of_week, start_time) 索引做區間掃描，再 join users 套用各自的
+reminder_window / notifications_on；每次都讀即時資料，課表或設定變更後下一個 tick 就生效。
+
+reminder_ledger 記錄 (user, schedule row, occurrence date) 是否已推播，避免 3 分鐘一次的
+tick 在 reminder_window 內重複推同一堂課；過了上課日期的紀錄會被清掉。
+"""
+from datetime import datetime, timedelta
+from .db import get_conn
+
+DEFAULT_WINDOW = 15
+MINUTES_PER_DAY = 24 * 60
+
+_DUE_SQL = """
+    SELECT s.id, s.user_id, s.course_name, s.day_of_week, s.start_time, s.end_time, s.location,
+           COALESCE(u.reminder_window, ?) AS reminder_window
+    FROM schedule s
+    JOIN users u ON u.user_id = s.user_id
+    WHERE s.day_of_week = ?
+      AND s.start_time >= ?
+      AND s.start_time <= ?
+      AND u.notifications_on = 1
+      AND (CAST(substr(s.start_time, 1, 2) AS INTEGER) * 60
+           + CAST(substr(s.start_time, 4, 2) AS INTEGER)) - ? <= COALESCE(u.reminder_window, ?)
+"""
+
+
+def _dow(date):
+    return ((date.isoweekday() - 1) % 7) + 1
+
+
+def _hm(minutes):
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+
+def max_reminder_window(conn=None):
+    own = conn is None
+    conn = conn or get_conn()
+    row = conn.execute(
+        "SELECT MAX(reminder_window) FROM users WHERE notifications_on = 1"
+    ).fetchone()
+    if own:
+        conn.close()
+    return int(row[0] or DEFAULT_WINDOW) if row else DEFAULT_WINDOW
+
+
+def find_due_classes(now: datetime, max_window=None):
+    """Return every class starting within its owner's reminder_window of ``now``.
+
+    每筆結果多帶 ``occurrence_date``（該堂課的日期，YYYY-MM-DD）與 ``minutes_until``。
+    跨午夜的提醒視窗會拆成今天 / 明天兩段區間。
+    """
+    conn = get_conn()
+    if max_window is None:
+        max_window = max_reminder_window(conn)
+    max_window = max(0, min(int(max_window), MINUTES_PER_DAY))
+    # 以「今天 00:00 起算的分鐘數」表示現在時刻，含秒數，與舊版 0 <= delta 的判斷一致
+    base = now.hour * 60 + now.minute + now.second / 60.0
+    horizon = base + max_window
+
+    due = []
+    day_offset = 0
+    while day_offset * MINUTES_PER_DAY <= horizon:
+        day = now + timedelta(days=day_offset)
+        day_base = base - day_offset * MINUTES_PER_DAY
+        lo = max(0, now.hour * 60 + now.minute - day_offset * MINUTES_PER_DAY)
+        hi = min(MINUTES_PER_DAY - 1, int(horizon - day_offset * MINUTES_PER_DAY))
+        if lo <= hi:
+            rows = conn.execute(
+                _DUE_SQL,
+                (DEFAULT_WINDOW, _dow(day), _hm(lo), _hm(hi), day_base, DEFAULT_WINDOW),
+            ).fetchall()
+            occurrence = day.strftime("%Y-%m-%d")
+            for r in rows:
+                item = dict(r)
+                start_min = int(item["start_time"][:2]) * 60 + int(item["start_time"][3:5])
+                minutes_until = start_min - day_base
+                if minutes_until < 0:
+                    continue
+                item["occurrence_date"] = occurrence
+                item["minutes_until"] = round(minutes_until, 1)
+                due.append(item)
+        day_offset += 1
+    conn.close()
+    return due
+
+
+def _key(item):
+    return (item["occurrence_date"], item["user_id"], item["id"])
+
+
+def sent_keys(occurrence_dates):
+    """Return {(occurrence_date, user_id, schedule_id)} already recorded for the given dates."""
+    dates = sorted(set(occurrence_dates))
+    if not dates:
+        return set()
+    conn = get_conn()
+    marks = ",".join("?" * len(dates))
+    rows = conn.execute(
+        f"SELECT occurrence_date, user_id, schedule_id FROM reminder_ledger WHERE occurrence_date IN ({marks})",
+        dates,
+    ).fetchall()
+    conn.close()
+    return {(r[0], r[1], r[2]) for r in rows}
+
+
+def pending_reminders(now: datetime, max_window=None):
+    """find_due_classes() 扣掉 ledger 裡已送出的項目（一次查詢 + set 比對）。"""
+    due = find_due_classes(now, max_window=max_window)
+    if not due:
+        return []
+    sent = sent_keys(item["occurrence_date"] for item in due)
+    return [item for item in due if _key(item) not in sent]
+
+
+def claim(items):
+    """把項目寫進 ledger，回傳實際搶到的項目。
+
+    INSERT OR IGNORE 讓多個 worker 的排程器同時跑時，同一堂課只有一個會推播。
+    """
+    if not items:
+        return []
+    sent_at = datetime.now().isoformat(timespec="seconds")
+    conn = get_conn()
+    claimed = []
+    for item in items:
+        cur = conn.execute(
+            "INSERT OR IGNORE INTO reminder_ledger(occurrence_date, user_id, schedule_id, sent_at) VALUES (?,?,?,?)",
+            _key(item) + (sent_at,),
+        )
+        if cur.rowcount:
+            claimed.append(item)
+    conn.commit()
+    conn.close()
+    return claimed
+
+
+def release(items):
+    """推播失敗時把 ledger 紀錄拿掉，下一個 tick 會再試。"""
+    if not items:
+        return
+    conn = get_conn()
+    conn.executemany(
+        "DELETE FROM reminder_ledger WHERE occurrence_date=? AND user_id=? AND schedule_id=?",
+        [_key(item) for item in items],
+    )
+    conn.commit()
+    conn.close()
+
+
+def purge_expired(now: datetime):
+    """刪除上課日期已過的 ledger 紀錄，讓表維持在「今天 + 明天」的大小。"""
+    conn = get_conn()
+    cur = conn.execute(
+        "DELETE FROM reminder_ledger WHERE occurrence_date < ?", (now.strftime("%Y-%m-%d"),)
+    )
+    deleted = cur.rowcount
+    conn.commit()
+    conn.close()
+    return deleted
@@ -1,8 +1,144 @@
+import hashlib
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from .background import BackgroundPool
+from .db import get_conn
+from .notes_service import get_notes_for_date, get_notes_in_range, get_notes_for_course
+from .summarize_service import build_review_pack, build_range_review, note_digest, _fallback_review, SUMMARY_MODEL
 
-from datetime import datetime
-from .notes_service import get_notes_for_date
-from .summarize_service import build_review_pack
+# 改了 build_review_pack 的 prompt 就要升版，舊的回顧包自然失效
+REVIEW_PROMPT_VERSION = 'review-v2'
 
-def generate_review_for_date(user_id, date_obj: datetime):
-    notes = get_notes_for_date(user_id, date_obj)
-    return build_review_pack(notes)
+# 週/月/課程回顧包可能要好幾次 LLM 呼叫，LINE 端改成背景產生後推播
+pool = BackgroundPool("review-pack", int(os.environ.get("REVIEW_WORKERS", "2")))
+
+_stats_lock = threading.Lock()
+_stats = {"hits": 0, "revalidated": 0, "misses": 0, "stores": 0}
+
+def _count(key):
+    with _stats_lock:
+        _stats[key] += 1
+
+def cache_stats():
+    with _stats_lock:
+        out = dict(_stats)
+    lookups = out["hits"] + out["revalidated"] + out["misses"]
+    out["hit_rate"] = round((out["hits"] + out["revalidated"]) / lookups, 3) if lookups else 0.0
+    return out
+
+def fingerprint(notes):
+    """以筆記 id + 內容 + 摘要算指紋；筆記增刪、改內容或背景摘要寫入後才會變。"""
+    h = hashlib.sha256(f"{REVIEW_PROMPT_VERSION}\0{SUMMARY_MODEL}\0".encode("utf-8"))
+    for n in sorted(notes, key=lambda n: n["id"]):
+        h.update(f"{n['id']}\0{n['content'] or ''}\0{n.get('summary') or ''}\0".encode("utf-8"))
+    return h.hexdigest()
+
+def cached_review(user_id, scope, load_notes, build=build_review_pack, refresh=False):
+    """回傳 scope（例如 'day:2025-01-01'）的回顧包，依筆記指紋快取在 review_cache。
+
+    沒被標記 stale 的直接回傳（一次 PK 查詢）；stale 的重新載入筆記比對指紋，
+    沒變就沿用，變了才呼叫 build。refresh=True 一律重新產生並覆蓋快取。
+    fallback（LLM 不可用）的結果不快取。
+    """
+    row = None
+    if not refresh:
+        conn = get_conn()
+        row = conn.execute(
+            "SELECT fingerprint, pack, stale FROM review_cache WHERE user_id=? AND scope=?", (user_id, scope)
+        ).fetchone()
+        conn.close()
+    if row and not row["stale"]:
+        _count("hits")
+        return row["pack"]
+    notes = load_notes()
+    if not notes:
+        return None
+    fp = fingerprint(notes)
+    if row and row["fingerprint"] == fp:
+        conn = get_conn()
+        conn.execute("UPDATE review_cache SET stale=0 WHERE user_id=? AND scope=?", (user_id, scope))
+        conn.commit()
+        conn.close()
+        _count("revalidated")
+        return row["pack"]
+    _count("misses")
+    pack = build(notes)
+    if pack and pack != _fallback_review(notes):
+        conn = get_conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO review_cache(user_id, scope, fingerprint, pack, stale, created_at) VALUES (?,?,?,?,0,?)",
+            (user_id, scope, fp, pack, time.time()),
+        )
+        conn.commit()
+        conn.close()
+        _count("stores")
+    return pack
+
+def generate_review_for_date(user_id, date_obj: datetime, refresh=False):
+    return cached_review(
+        user_id, f"day:{date_obj:%Y-%m-%d}", lambda: get_notes_for_date(user_id, date_obj), refresh=refresh
+    )
+
+def _day_sections(user_id, notes):
+    """把筆記依日期分段；當天的回顧包快取仍有效就直接拿來當輸入，否則用每則的 summary。"""
+    by_day = {}
+    for n in notes:
+        by_day.setdefault(n["ts"][:10], []).append(n)
+    scopes = [f"day:{day}" for day in by_day]
+    cached = {}
+    conn = get_conn()
+    for i in range(0, len(scopes), 400):
+        chunk = scopes[i:i + 400]
+        rows = conn.execute(
+            f"SELECT scope, fingerprint, pack FROM review_cache WHERE user_id=? AND scope IN ({','.join('?' * len(chunk))})",
+            [user_id, *chunk],
+        ).fetchall()
+        cached.update((r["scope"], r) for r in rows)
+    conn.close()
+    sections = []
+    for day in sorted(by_day):
+        day_notes = by_day[day]
+        row = cached.get(f"day:{day}")
+        if row and row["fingerprint"] == fingerprint(day_notes):
+            sections.append(f"[{day} 回顧包]\n{row['pack']}")
+        else:
+            sections.append(f"[{day}]\n" + "\n".join(note_digest(n) for n in day_notes))
+    return sections
+
+def _range_review(user_id, scope, label, load_notes):
+    return cached_review(
+        user_id, scope, load_notes,
+        build=lambda notes: build_range_review(_day_sections(user_id, notes), notes, label),
+    )
+
+def generate_review_for_week(user_id, date_obj: datetime):
+    """date_obj 所在那一週（週一起算）到當天為止的回顧包。"""
+    start = (date_obj - timedelta(days=date_obj.weekday())).date()
+    end = date_obj.date() + timedelta(days=1)
+    return _range_review(user_id, f"week:{start}", "本週", lambda: get_notes_in_range(user_id, start, end))
+
+def generate_review_for_month(user_id, date_obj: datetime):
+    start = date_obj.date().replace(day=1)
+    end = date_obj.date() + timedelta(days=1)
+    return _range_review(user_id, f"month:{start:%Y-%m}", "本月", lambda: get_notes_in_range(user_id, start, end))
+
+def generate_review_for_course(user_id, course_name):
+    return _range_review(
+        user_id, f"course:{course_name}", f"「{course_name}」這門課",
+        lambda: get_notes_for_course(user_id, course_name),
+    )
+
+def generate_review(user_id, period="today", course_name=None, now=None):
+    """依 period（today/week/month/course）產生回顧包；不認得的 period 回傳 None。"""
+    now = now or datetime.now()
+    if period == "today":
+        return generate_review_for_date(user_id, now)
+    if period == "week":
+        return generate_review_for_week(user_id, now)
+    if period == "month":
+        return generate_review_for_month(user_id, now)
+    if period == "course" and course_name:
+        return generate_review_for_course(user_id, course_name)
+    return None
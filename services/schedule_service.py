@@ -1,41 +1,113 @@
 
+import re
 from datetime import datetime, timedelta
 from .db import get_conn
 
 
-def add_course(user_id, course_name, dow, start_time, end_time, location=None):
-    # 基本時間檢查，避免倒流
-    if start_time >= end_time:
-        raise ValueError(f"結束時間 ({end_time}) 不能早於或等於開始時間 ({start_time})。")
+def normalize_hm(value):
+    """'9:00' → '09:00'；無法解析就原樣回傳，交給後續檢查處理。"""
+    value = str(value or "").strip()
+    parts = value.split(":")
+    if len(parts) != 2 or not all(p.isdigit() for p in parts):
+        return value
+    return f"{int(parts[0]):02d}:{int(parts[1]):02d}"
 
-    conn = get_conn()
 
-    # 檢查衝堂，同一天任一時段重疊就拒絕
-    cursor = conn.execute(
-        """
-        SELECT course_name FROM schedule
-        WHERE user_id = ?
-          AND day_of_week = ?
-          AND start_time < ?
-          AND end_time > ?
-    """,
-        (user_id, dow, end_time, start_time),
-    )
-    conflict = cursor.fetchone()
-    if conflict:
+_HM_RE = re.compile(r"(?:[01][0-9]|2[0-3]):[0-5][0-9]")
+
+
+def _overlap(day_rows, start_time, end_time):
+    """回傳同一天與 [start_time, end_time) 重疊的課名，沒有則 None。"""
+    for name, s, e in day_rows:
+        if s < end_time and e > start_time:
+            return name
+    return None
+
+
+def add_courses(user_id, courses):
+    """一次匯入多堂課，回傳與 courses 對齊的結果 list：{"ok", "course_name", "error"}。
+
+    courses 是 dict 的 iterable（course_name, day_of_week, start_time, end_time, location，
+    可另帶 user_id 覆蓋預設）。既有課表只查一次，衝堂在記憶體中同時比對既有課程與
+    這批裡已接受的課程；全部以一次 executemany 寫入，整批一個 transaction。
+    """
+    rows = []
+    for c in courses:
+        c = dict(c)
+        uid = c.get("user_id") or user_id
+        name = (c.get("course_name") or "").strip()
+        start_time = normalize_hm(c.get("start_time"))
+        end_time = normalize_hm(c.get("end_time"))
+        error = None
         try:
-            exist_name = conflict["course_name"]
-        except Exception:
-            exist_name = conflict[0]
+            dow = int(c.get("day_of_week"))
+        except (TypeError, ValueError):
+            dow = None
+            error = f"星期格式錯誤：{c.get('day_of_week')}"
+        if not error and not (uid and name):
+            error = "缺少課程名稱"
+        # 時間必須是 HH:MM，提醒功能會直接拿來做分鐘運算
+        if not error:
+            bad = [v for v in (start_time, end_time) if not _HM_RE.fullmatch(v)]
+            if bad:
+                error = f"時間格式錯誤：{bad[0] or '(空白)'}，請用 HH:MM。"
+        # 基本時間檢查，避免倒流
+        if not error and start_time >= end_time:
+            error = f"結束時間 ({end_time}) 不能早於或等於開始時間 ({start_time})。"
+        rows.append((uid, name, dow, start_time, end_time, c.get("location") or None, error))
+
+    results = []
+    conn = get_conn()
+    # 讀既有課表與寫入在同一個 transaction，兩個匯入同時進行也不會互相漏掉衝堂。
+    # 呼叫端已有進行中的寫入時，get_conn 回傳的是 savepoint 包住的巢狀連線：
+    # 不另開 transaction，下面的 commit / rollback 也只作用在這個 savepoint
+    if not conn.in_transaction:
+        conn.execute("BEGIN IMMEDIATE")
+    try:
+        users = sorted({r[0] for r in rows if r[0]})
+        taken = {}
+        for i in range(0, len(users), 500):
+            chunk = users[i:i + 500]
+            for r in conn.execute(
+                f"SELECT user_id, day_of_week, course_name, start_time, end_time FROM schedule "
+                f"WHERE user_id IN ({','.join('?' * len(chunk))})",
+                chunk,
+            ):
+                taken.setdefault((r["user_id"], r["day_of_week"]), []).append(
+                    (r["course_name"], r["start_time"], r["end_time"]))
+        inserts = []
+        for uid, name, dow, start_time, end_time, location, error in rows:
+            if not error:
+                day_rows = taken.setdefault((uid, dow), [])
+                exist_name = _overlap(day_rows, start_time, end_time)
+                if exist_name:
+                    # 同一天任一時段重疊就拒絕
+                    error = f"該時段已經有「{exist_name}」課程，無法新增衝堂課程"
+                else:
+                    day_rows.append((name, start_time, end_time))
+                    inserts.append((uid, name, dow, start_time, end_time, location))
+            results.append({"ok": error is None, "course_name": name, "error": error})
+        if inserts:
+            conn.executemany(
+                "INSERT INTO schedule(user_id, course_name, day_of_week, start_time, end_time, location) VALUES (?,?,?,?,?,?)",
+                inserts,
+            )
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
         conn.close()
-        raise ValueError(f"該時段已經有「{exist_name}」課程，無法新增衝堂課程")
+    return results
 
-    conn.execute(
-        "INSERT INTO schedule(user_id, course_name, day_of_week, start_time, end_time, location) VALUES (?,?,?,?,?,?)",
-        (user_id, course_name, dow, start_time, end_time, location),
-    )
-    conn.commit()
-    conn.close()
+
+def add_course(user_id, course_name, dow, start_time, end_time, location=None):
+    result = add_courses(user_id, [{
+        "course_name": course_name, "day_of_week": dow,
+        "start_time": start_time, "end_time": end_time, "location": location,
+    }])[0]
+    if not result["ok"]:
+        raise ValueError(result["error"])
     return True
 
 def get_day_schedule(user_id, date: datetime):
@@ -1,28 +1,25 @@
-
 import csv, os, sys, pathlib
 
 # Allow running as script: `python services/seed_data.py`
 if __package__ is None:  # executed directly
     sys.path.append(str(pathlib.Path(__file__).resolve().parent.parent))
-    from services.db import init_db, get_conn  # type: ignore
+    from services.db import init_db  # type: ignore
+    from services.schedule_service import add_courses  # type: ignore
 else:
-    from .db import init_db, get_conn
+    from .db import init_db
+    from .schedule_service import add_courses
 
 CSV_PATH = os.environ.get('SCHEDULE_CSV', os.path.join(os.path.dirname(__file__), '..', 'data', 'schedule.sample.csv'))
 
 def main():
     init_db()
-    conn = get_conn()
     with open(CSV_PATH, newline='', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            conn.execute(
-                "INSERT INTO schedule(user_id, course_name, day_of_week, start_time, end_time, location) VALUES (?,?,?,?,?,?)",
-                (row['user_id'], row['course_name'], int(row['day_of_week']), row['start_time'], row['end_time'], row['location'])
-            )
-    conn.commit()
-    conn.close()
-    print('Seeded schedule from', CSV_PATH)
+        # 每列帶自己的 user_id；衝堂的列略過，其餘一次寫入
+        results = add_courses(None, csv.DictReader(f))
+    for r in results:
+        if not r['ok']:
+            print(f"  skipped {r['course_name']}: {r['error']}")
+    print(f"Seeded {sum(1 for r in results if r['ok'])} of {len(results)} courses from", CSV_PATH)
 
 if __name__ == '__main__':
     main()
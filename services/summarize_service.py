@@ -1,29 +1,91 @@
 
+import hashlib
+import json
 import os
-import google.generativeai as genai
-
-def _maybe_init():
-    key = os.environ.get('GEMINI_API_KEY')
-    if key:
-        genai.configure(api_key=key)
-        return genai.GenerativeModel('gemini-1.5-flash')
-    return None
-
-def _fallback_note_summary(text: str) -> str | None:
-    """當沒有 LLM 時，取內容前幾句作為摘要。"""
-    if not text:
-        return None
-    parts = [p.strip() for p in text.replace("\r", "\n").split("\n") if p.strip()]
-    bullets = []
-    for p in parts:
-        if len(bullets) >= 4:
-            break
-        if len(p) > 120:
-            p = p[:117] + "..."
-        bullets.append(f"• {p}")
-    if not bullets:
-        return None
-    return "\n".join(bullets)
+import re
+import threading
+import time
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+from . import extractive_summary, llm_client
+from .db import get_conn
+
+# 快取 key 含模型名稱：換模型後舊摘要自然失效
+SUMMARY_MODEL = llm_client.MODEL_NAME
+# 改了 summarize_note 的 prompt 就要升版，舊的快取自然失效
+NOTE_PROMPT_VERSION = 'note-v1'
+SUMMARY_CACHE_MAX = int(os.environ.get('SUMMARY_CACHE_MAX', '5000'))
+# 短於這個字數（或句子不多）的筆記直接用抽取式摘要，不呼叫 LLM；0 = 一律用 LLM
+SUMMARY_LLM_MIN_CHARS = int(os.environ.get('SUMMARY_LLM_MIN_CHARS', '300'))
+# 批次摘要：一次 prompt 最多塞多少 token（粗估）/ 幾則筆記
+SUMMARY_BATCH_TOKENS = int(os.environ.get('SUMMARY_BATCH_TOKENS', '6000'))
+SUMMARY_BATCH_SIZE = int(os.environ.get('SUMMARY_BATCH_SIZE', '20'))
+
+_cache_lock = threading.Lock()
+_cache_stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "extractive": 0}
+
+def _normalize_note(text: str) -> str:
+    """NFKC、統一換行、去掉每行首尾空白與空行；貼上時多出來的空白不影響快取命中。"""
+    text = unicodedata.normalize("NFKC", text or "").replace("\r\n", "\n").replace("\r", "\n")
+    return "\n".join(line.strip() for line in text.split("\n") if line.strip())
+
+def summary_cache_key(text: str) -> str:
+    raw = f"{NOTE_PROMPT_VERSION}\0{SUMMARY_MODEL}\0{_normalize_note(text)}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def _count(key, n=1):
+    with _cache_lock:
+        _cache_stats[key] += n
+
+def _cache_get(key):
+    conn = get_conn()
+    row = conn.execute("SELECT summary FROM summary_cache WHERE key=?", (key,)).fetchone()
+    if row:
+        conn.execute("UPDATE summary_cache SET last_used_at=?, hits=hits+1 WHERE key=?", (time.time(), key))
+        conn.commit()
+    conn.close()
+    return row["summary"] if row else None
+
+def _cache_put(key, summary):
+    now = time.time()
+    conn = get_conn()
+    conn.execute(
+        "INSERT OR REPLACE INTO summary_cache(key, summary, created_at, last_used_at, hits) VALUES (?,?,?,?,0)",
+        (key, summary, now, now),
+    )
+    excess = conn.execute("SELECT COUNT(*) FROM summary_cache").fetchone()[0] - SUMMARY_CACHE_MAX
+    if excess > 0:
+        # LRU：淘汰最久沒被用到的
+        conn.execute(
+            "DELETE FROM summary_cache WHERE key IN (SELECT key FROM summary_cache ORDER BY last_used_at LIMIT ?)",
+            (excess,),
+        )
+        _count("evictions", excess)
+    conn.commit()
+    conn.close()
+    _count("stores")
+
+def cache_stats():
+    with _cache_lock:
+        out = dict(_cache_stats)
+    lookups = out["hits"] + out["misses"]
+    out["hit_rate"] = round(out["hits"] / lookups, 3) if lookups else 0.0
+    out["max_entries"] = SUMMARY_CACHE_MAX
+    return out
+
+def _extractive(text: str) -> str | None:
+    """本機抽取式摘要：短筆記與沒有 LLM（或 LLM 失敗）時使用。"""
+    _count("extractive")
+    return extractive_summary.summarize(text)
+
+def needs_llm(text: str) -> bool:
+    """路由：夠長、句子夠多的筆記才值得呼叫 LLM；其餘抽取式摘要就夠用。"""
+    if not llm_client.available():
+        return False
+    if SUMMARY_LLM_MIN_CHARS <= 0:
+        return True
+    norm = _normalize_note(text)
+    return len(norm) >= SUMMARY_LLM_MIN_CHARS and len(extractive_summary.split_sentences(norm)) > 4
 
 def _fallback_review(notes):
     """If LLM 不可用，也提供簡易回顧包，避免回覆空白。"""
@@ -44,35 +106,197 @@ def _fallback_review(notes):
     lines.append("- 嘗試手寫本日筆記的重點與例題解法。")
     return "\n".join(lines)
 
-def summarize_note(text: str):
-    model = _maybe_init()
-    if not model:
-        return _fallback_note_summary(text)
+def summarize_note(text: str, use_cache: bool = True):
+    """產生筆記重點。短筆記走抽取式摘要；長筆記相同內容（正規化後）+ 相同 prompt/model 版本只會呼叫一次 LLM。"""
+    if not needs_llm(text):
+        return _extractive(text)
+    key = summary_cache_key(text)
+    if use_cache:
+        cached = _cache_get(key)
+        if cached:
+            _count("hits")
+            return cached
+        _count("misses")
     prompt = f"請用繁體中文幫我把下面的上課筆記整理成 3~5 個重點條列，盡量短句：\n{text}\n"
     try:
-        res = model.generate_content(prompt)
-        return (res.text or '').strip()
-    except Exception:
-        return _fallback_note_summary(text)
+        summary = llm_client.generate(prompt, kind="note_summary")
+    except llm_client.LLMError:
+        return _extractive(text)
+    if summary:
+        _cache_put(key, summary)
+    return summary
 
-def build_review_pack(notes):
-    if not notes:
-        return None
-    model = _maybe_init()
-    if not model:
-        return _fallback_review(notes)
-    texts = "\n\n".join([f"[筆記 {i+1}]\n{n['content']}\n(摘要: {n.get('summary') or '無'})" for i, n in enumerate(notes)])
-    prompt = f"""以下是今天的多段上課筆記，請以繁體中文產生「重點回顧包」四個區塊：
+def _estimate_tokens(text: str) -> int:
+    """粗估 token 數：CJK 約一字一 token，其餘約 4 字元一 token。"""
+    cjk = sum(1 for ch in text if ord(ch) >= 0x2E80)
+    return cjk + (len(text) - cjk) // 4 + 1
+
+def _pack_batches(items, budget=None, max_items=None):
+    """把 [(key, text), ...] 依 token 預算切成多批；單則超過預算的自己一批。"""
+    budget = budget or SUMMARY_BATCH_TOKENS
+    max_items = max_items or SUMMARY_BATCH_SIZE
+    batches, cur, used = [], [], 0
+    for key, text in items:
+        cost = _estimate_tokens(text)
+        if cur and (used + cost > budget or len(cur) >= max_items):
+            batches.append(cur)
+            cur, used = [], 0
+        cur.append((key, text))
+        used += cost
+    if cur:
+        batches.append(cur)
+    return batches
+
+def _parse_batch_response(raw: str, ids):
+    """解析 {"id": "重點..."} 的 JSON 回應；格式不對就回傳空 dict，由呼叫端逐則補。"""
+    raw = re.sub(r"^```(?:json)?\s*|\s*```$", "", (raw or "").strip())
+    try:
+        data = json.loads(raw)
+    except ValueError:
+        return {}
+    if not isinstance(data, dict):
+        return {}
+    out = {}
+    for i in ids:
+        val = data.get(str(i))
+        if isinstance(val, list):
+            val = "\n".join(f"• {str(v).lstrip('•-* ').strip()}" for v in val if str(v).strip())
+        if isinstance(val, str) and val.strip():
+            out[i] = val.strip()
+    return out
+
+def _summarize_batch(batch):
+    """一次 LLM 呼叫摘要一批筆記，回傳 {index: summary}（只含成功解析的）。"""
+    payload = json.dumps({str(i): text for i, text in batch}, ensure_ascii=False)
+    prompt = (
+        "以下 JSON 物件的每個值都是一段上課筆記。請用繁體中文把每段筆記各自整理成 3~5 個重點條列，盡量短句。\n"
+        "只回傳 JSON 物件，key 與輸入相同，值是以「• 」開頭、換行分隔的重點字串，不要其他文字。\n"
+        f"{payload}\n"
+    )
+    try:
+        raw = llm_client.generate(prompt, kind="note_summary_batch",
+                                  generation_config={"response_mime_type": "application/json"})
+    except llm_client.LLMError as e:
+        print(f"[summarize] batch of {len(batch)} failed: {e!r}")
+        return {}
+    return _parse_batch_response(raw, [i for i, _ in batch])
+
+def summarize_notes(texts, use_cache: bool = True):
+    """批次版 summarize_note：回傳與 texts 對齊的摘要 list。
+
+    先查快取，剩下的（同內容只算一次）依 token 預算打包成少數幾次 LLM 呼叫；
+    回應解析失敗或缺漏的筆記再逐則呼叫 summarize_note。
+    """
+    texts = list(texts)
+    keys = [summary_cache_key(t) for t in texts]
+    results = {}
+    todo = {}
+    for t, key in zip(texts, keys):
+        if key in results or key in todo:
+            continue
+        if not needs_llm(t):
+            results[key] = _extractive(t)
+            continue
+        cached = _cache_get(key) if use_cache else None
+        if cached:
+            _count("hits")
+            results[key] = cached
+        else:
+            if use_cache:
+                _count("misses")
+            todo[key] = t
+    pending = list(todo.items())
+    for batch in _pack_batches([(i, t) for i, (_, t) in enumerate(pending)]):
+        if len(batch) == 1:
+            continue
+        for i, summary in _summarize_batch(batch).items():
+            key = pending[i][0]
+            results[key] = summary
+            _cache_put(key, summary)
+    for key, t in pending:
+        if key not in results:
+            results[key] = summarize_note(t, use_cache=False)
+    return [results.get(key) for key in keys]
+
+# 回顧包 prompt 的 token 預算；超過就先把輸入分塊濃縮（map-reduce）
+REVIEW_TOKEN_BUDGET = int(os.environ.get('REVIEW_TOKEN_BUDGET', '8000'))
+REVIEW_REDUCE_WORKERS = int(os.environ.get('REVIEW_REDUCE_WORKERS', '4'))
+_REDUCE_ROUNDS = 3
+
+def _clip(text: str, tokens: int) -> str:
+    """把單段文字裁到約 tokens 以內（以一字一 token 保守估計）。"""
+    return text if _estimate_tokens(text) <= tokens else text[:tokens] + "…"
+
+def note_digest(n) -> str:
+    """回顧包的筆記輸入：優先用已產生的 summary，沒有才用原文。"""
+    course = n.get("course_name")
+    body = (n.get("summary") or n.get("content") or "").strip()
+    return f"({course}) {body}" if course else body
+
+def _reduce_chunk(label, chunk):
+    joined = "\n\n".join(text for _, text in chunk)
+    prompt = (
+        f"以下是{label}的部分上課筆記重點，請用繁體中文合併濃縮成條列重點，"
+        "保留重要術語、公式與易混淆處，刪掉重複內容：\n"
+        f"{joined}\n"
+    )
+    try:
+        out = llm_client.generate(prompt, kind="review_reduce")
+    except llm_client.LLMError as e:
+        print(f"[review] reduce failed: {e!r}")
+        out = ''
+    # 失敗時退回裁切後的原文，確保每輪都會變短
+    return out or _clip(joined, max(200, REVIEW_TOKEN_BUDGET // max(2, len(chunk))))
+
+def _condense(label, texts, budget=None):
+    """map-reduce：輸入超過 budget 時分塊並行濃縮，直到放得進單一 prompt。"""
+    budget = budget or REVIEW_TOKEN_BUDGET
+    texts = [_clip(t, budget) for t in texts if t]
+    for _ in range(_REDUCE_ROUNDS):
+        if len(texts) <= 1 or sum(_estimate_tokens(t) for t in texts) <= budget:
+            return texts
+        batches = _pack_batches(list(enumerate(texts)), budget=budget, max_items=len(texts))
+        workers = max(1, min(REVIEW_REDUCE_WORKERS, len(batches)))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="review-reduce") as ex:
+            texts = list(ex.map(lambda chunk: _reduce_chunk(label, chunk), batches))
+    # 還是太長就平均裁切
+    share = max(100, budget // max(1, len(texts)))
+    return [_clip(t, share) for t in texts]
+
+def _review_prompt(label, texts):
+    body = "\n\n".join(texts)
+    return f"""以下是{label}的上課筆記（或其重點），請以繁體中文產生「重點回顧包」四個區塊：
 1) 摘要 (100~200字) 
 2) 名詞解釋 (列出重要術語並逐點解釋)
 3) 可能考點 (條列重點與易混淆處)
 4) 練習題 (3~5 題，附簡短解答或提示)
 
 內容：
-{texts}
+{body}
 """
+
+def build_review_pack(notes, label="今天"):
+    if not notes:
+        return None
+    if not llm_client.available():
+        return _fallback_review(notes)
+    texts = [f"[筆記 {i+1}]\n{n['content']}\n(摘要: {n.get('summary') or '無'})" for i, n in enumerate(notes)]
+    if sum(_estimate_tokens(t) for t in texts) > REVIEW_TOKEN_BUDGET:
+        # 原文放不下就改用每則的 summary，再不夠才分塊濃縮
+        texts = _condense(label, [f"[筆記 {i+1}]\n{note_digest(n)}" for i, n in enumerate(notes)])
+    try:
+        return llm_client.generate(_review_prompt(label, texts), kind="review")
+    except llm_client.LLMError:
+        return _fallback_review(notes)
+
+def build_range_review(sections, notes, label):
+    """週/月/課程回顧包：sections 是已整理好的分段輸入（例如每天的回顧包或摘要）。"""
+    if not notes:
+        return None
+    if not llm_client.available():
+        return _fallback_review(notes)
+    texts = _condense(label, sections)
     try:
-        res = model.generate_content(prompt)
-        return (res.text or '').strip()
-    except Exception:
+        return llm_client.generate(_review_prompt(label, texts), kind="review")
+    except llm_client.LLMError:
         return _fallback_review(notes)
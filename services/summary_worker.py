@@ -0,0 +1,68 @@
+"""Background note summarization.
+
+要走 LLM 的筆記 add_note 先存成 summary_status='pending' 立刻回覆，摘要交給這裡的 worker pool 產生
+（短筆記的抽取式摘要在 add_note 當場完成，不進佇列）；
+完成後更新 notes，並（若有註冊 notifier）推播給使用者。
+"""
+import os
+
+from . import notes_service
+from .background import BackgroundPool
+from .db import get_conn
+from .summarize_service import summarize_note
+
+SUMMARY_WORKERS = int(os.environ.get("SUMMARY_WORKERS", "2"))
+
+pool = BackgroundPool("note-summary", SUMMARY_WORKERS)
+_notifier = None
+
+
+def set_notifier(fn):
+    """註冊 fn(user_id, note_dict)，摘要完成且 enqueue 時要求通知才會呼叫。"""
+    global _notifier
+    _notifier = fn
+
+
+def enqueue(note_id, notify=False):
+    return pool.submit(summarize_pending_note, note_id, notify)
+
+
+def summarize_pending_note(note_id, notify=False):
+    conn = get_conn()
+    row = conn.execute("SELECT * FROM notes WHERE id=?", (note_id,)).fetchone()
+    conn.close()
+    if not row:
+        return None
+    if row["summary"]:
+        if row["summary_status"] != "done":
+            conn = get_conn()
+            conn.execute("UPDATE notes SET summary_status='done' WHERE id=?", (note_id,))
+            conn.commit()
+            conn.close()
+        return None
+    if not notes_service.claim_for_summary([note_id]):
+        # 排程 backfill 或 CLI 正在做這則
+        return None
+    summary = summarize_note(row["content"]) or None
+    conn = get_conn()
+    conn.execute(
+        "UPDATE notes SET summary=?, summary_status=? WHERE id=?",
+        (summary, "done" if summary else "failed", note_id),
+    )
+    if summary:
+        # 回顧包的指紋含摘要，寫入後要讓快取重新比對
+        notes_service._mark_reviews_stale(conn, row["user_id"])
+    conn.commit()
+    conn.close()
+    if summary and notify and _notifier:
+        note = dict(row)
+        note["summary"] = summary
+        try:
+            _notifier(note["user_id"], note)
+        except Exception as e:
+            print(f"[note-summary] notify failed: {e!r}")
+    return summary
+
+
+def stats():
+    return pool.stats()
@@ -0,0 +1,176 @@
+"""Cross-worker upload sessions for LINE schedule-image OCR.
+
+「/schedule upload image」之後的圖片與狀態不放在行程記憶體：
+- 狀態存在 SQLite（upload_sessions），圖片以串流方式寫到 UPLOAD_DIR 下的檔案（upload_images 記錄路徑）
+- 任何 gunicorn worker 收到「完成」都能以 take_images 取得同一批圖片，交給 ocr_jobs 背景辨識
+- 每位使用者有張數 / 總位元組上限，單張也有上限；超過 TTL 沒動作的 session 由排程清掉
+"""
+import os
+import pathlib
+import time
+import uuid
+
+from . import db
+from .db import get_conn
+
+UPLOAD_MAX_IMAGES = int(os.environ.get("UPLOAD_MAX_IMAGES", "10"))
+UPLOAD_MAX_IMAGE_BYTES = int(os.environ.get("UPLOAD_MAX_IMAGE_BYTES", str(10 * 1024 * 1024)))
+UPLOAD_MAX_BYTES = int(os.environ.get("UPLOAD_MAX_BYTES", str(30 * 1024 * 1024)))
+UPLOAD_TTL_MINUTES = int(os.environ.get("UPLOAD_TTL_MINUTES", "30"))
+
+SCHEDULE_IMAGES = "WAIT_SCHEDULE_IMG"
+
+
+class UploadLimitError(ValueError):
+    """超過張數或大小上限；訊息可以直接回給使用者。"""
+
+
+def _upload_dir():
+    path = os.environ.get("UPLOAD_DIR") or str(pathlib.Path(db.DB_PATH).resolve().parent / "uploads")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _remove_files(paths):
+    for p in paths:
+        try:
+            os.remove(p)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"[upload] remove {p} failed: {e!r}")
+
+
+def _drop(conn, user_id):
+    """刪除 user 的 session 與圖片列，回傳要刪的檔案路徑（呼叫端 commit 後再刪檔）。"""
+    paths = [r["path"] for r in conn.execute("SELECT path FROM upload_images WHERE user_id=? ORDER BY id", (user_id,))]
+    conn.execute("DELETE FROM upload_images WHERE user_id=?", (user_id,))
+    conn.execute("DELETE FROM upload_sessions WHERE user_id=?", (user_id,))
+    return paths
+
+
+def start_session(user_id, state=SCHEDULE_IMAGES):
+    """開始新的上傳流程（清掉這位使用者之前沒完成的圖片）。"""
+    now = time.time()
+    conn = get_conn()
+    with conn:
+        paths = _drop(conn, user_id)
+        conn.execute(
+            "INSERT INTO upload_sessions(user_id, state, created_at, expires_at) VALUES (?,?,?,?)",
+            (user_id, state, now, now + UPLOAD_TTL_MINUTES * 60),
+        )
+    conn.close()
+    _remove_files(paths)
+
+
+def get_state(user_id):
+    """目前的上傳狀態；沒有或已過期回傳 None。"""
+    conn = get_conn()
+    row = conn.execute(
+        "SELECT state FROM upload_sessions WHERE user_id=? AND expires_at > ?", (user_id, time.time())
+    ).fetchone()
+    conn.close()
+    return row["state"] if row else None
+
+
+def image_count(user_id):
+    conn = get_conn()
+    n = conn.execute("SELECT COUNT(*) FROM upload_images WHERE user_id=?", (user_id,)).fetchone()[0]
+    conn.close()
+    return n
+
+
+def save_image(user_id, chunks):
+    """把 chunks（bytes 的 iterable）串流寫進 spool 檔並登記，回傳目前張數。
+
+    寫入中超過單張或總量上限就中止並丟 UploadLimitError；張數在 BEGIN IMMEDIATE 內檢查，
+    兩個 worker 同時收到圖片也不會超過上限。
+    """
+    conn = get_conn()
+    row = conn.execute(
+        "SELECT COUNT(*) AS n, COALESCE(SUM(size), 0) AS used FROM upload_images WHERE user_id=?", (user_id,)
+    ).fetchone()
+    conn.close()
+    if row["n"] >= UPLOAD_MAX_IMAGES:
+        raise UploadLimitError(f"最多只能上傳 {UPLOAD_MAX_IMAGES} 張圖片，請輸入「完成」開始辨識。")
+    limit = min(UPLOAD_MAX_IMAGE_BYTES, UPLOAD_MAX_BYTES - row["used"])
+    path = os.path.join(_upload_dir(), f"{uuid.uuid4().hex}.img")
+    size = 0
+    try:
+        with open(path + ".part", "wb") as f:
+            for chunk in chunks:
+                size += len(chunk)
+                if size > limit:
+                    raise UploadLimitError("圖片太大或總容量已達上限，請改傳較小的截圖。")
+                f.write(chunk)
+        os.replace(path + ".part", path)
+    except BaseException:
+        _remove_files([path + ".part"])
+        raise
+
+    now = time.time()
+    conn = get_conn()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        n = conn.execute("SELECT COUNT(*) FROM upload_images WHERE user_id=?", (user_id,)).fetchone()[0]
+        active = conn.execute(
+            "SELECT 1 FROM upload_sessions WHERE user_id=? AND expires_at > ?", (user_id, now)
+        ).fetchone()
+        if not active or n >= UPLOAD_MAX_IMAGES:
+            conn.rollback()
+            _remove_files([path])
+            if not active:
+                raise UploadLimitError("上傳流程已逾時，請重新輸入 /schedule upload image。")
+            raise UploadLimitError(f"最多只能上傳 {UPLOAD_MAX_IMAGES} 張圖片，請輸入「完成」開始辨識。")
+        conn.execute(
+            "INSERT INTO upload_images(user_id, path, size, created_at) VALUES (?,?,?,?)",
+            (user_id, path, size, now),
+        )
+        # 有動作就延長 session
+        conn.execute(
+            "UPDATE upload_sessions SET expires_at=? WHERE user_id=?", (now + UPLOAD_TTL_MINUTES * 60, user_id)
+        )
+        conn.commit()
+    finally:
+        conn.close()
+    return n + 1
+
+
+def take_images(user_id):
+    """結束上傳流程並把圖片檔的所有權交給呼叫端：回傳依上傳順序的檔案路徑，不刪檔。"""
+    conn = get_conn()
+    with conn:
+        paths = _drop(conn, user_id)
+    conn.close()
+    return paths
+
+
+def purge_expired(now=None):
+    """清掉過期的 session、其圖片，以及沒有登記的殘留檔（例如寫到一半 worker 被砍）。"""
+    now = now or time.time()
+    conn = get_conn()
+    with conn:
+        users = [r["user_id"] for r in conn.execute("SELECT user_id FROM upload_sessions WHERE expires_at <= ?", (now,))]
+        paths = []
+        for user_id in users:
+            paths += _drop(conn, user_id)
+        # session 已不存在的孤兒圖片列
+        orphans = conn.execute(
+            "SELECT id, path FROM upload_images WHERE user_id NOT IN (SELECT user_id FROM upload_sessions)"
+        ).fetchall()
+        if orphans:
+            conn.executemany("DELETE FROM upload_images WHERE id=?", [(r["id"],) for r in orphans])
+            paths += [r["path"] for r in orphans]
+        known = {r["path"] for r in conn.execute("SELECT path FROM upload_images")}
+    conn.close()
+    _remove_files(paths)
+    cutoff = now - UPLOAD_TTL_MINUTES * 60
+    spool = _upload_dir()
+    for name in os.listdir(spool):
+        p = os.path.join(spool, name)
+        try:
+            if p not in known and os.path.getmtime(p) < cutoff:
+                _remove_files([p])
+        except OSError:
+            pass
+    return len(users)
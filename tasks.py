@@ -3,51 +3,88 @@ import os
 from datetime import datetime
 from apscheduler.schedulers.background import BackgroundScheduler
 from pytz import timezone
-from services import news_service, schedule_service, db
+from services import db, news_service, notes_service, ocr_jobs, reminder_service, upload_store
 
-def start_scheduler(line_bot_api):
+SUMMARY_BACKFILL_MINUTES = int(os.environ.get('SUMMARY_BACKFILL_MINUTES', '2'))
+SUMMARY_BACKFILL_BUDGET = int(os.environ.get('SUMMARY_BACKFILL_BUDGET', '20'))
+
+def start_scheduler(line_bot_api=None):
     tz = timezone(os.environ.get('TIMEZONE', 'Asia/Taipei'))
     scheduler = BackgroundScheduler(timezone=tz)
 
+    @scheduler.scheduled_job('interval', minutes=SUMMARY_BACKFILL_MINUTES, id='summary_backfill')
+    @db.background_job
+    def backfill_summaries():
+        # 多個 worker 只讓一個跑；每輪最多 SUMMARY_BACKFILL_BUDGET 筆，backlog 再大也不會卡住
+        with db.job_lock('summary_backfill') as lk:
+            if not lk.acquired:
+                return
+            done = notes_service.backfill_pending(budget=SUMMARY_BACKFILL_BUDGET)
+            if done:
+                print(f"[summary_backfill] filled {done} summaries")
+
+    @scheduler.scheduled_job('interval', minutes=10, id='upload_purge')
+    @db.background_job
+    def purge_uploads():
+        # 放棄的課表圖片上傳（超過 UPLOAD_TTL_MINUTES）連同 spool 檔一起清掉
+        with db.job_lock('upload_purge') as lk:
+            if lk.acquired:
+                upload_store.purge_expired()
+
+    @scheduler.scheduled_job('interval', minutes=5, id='ocr_job_recover')
+    @db.background_job
+    def recover_ocr_jobs():
+        # worker 重啟時沒跑完的課表辨識工作重新排入，並清掉過期的工作紀錄
+        with db.job_lock('ocr_job_recover') as lk:
+            if not lk.acquired:
+                return
+            n = ocr_jobs.recover_stale()
+            if n:
+                print(f"[ocr_job_recover] requeued {n} jobs")
+
     @scheduler.scheduled_job('interval', minutes=60, id='news_crawler')
+    @db.background_job
     def crawl_news():
-        from linebot.models import TextSendMessage
-        conn = db.get_conn()
-        users = conn.execute("SELECT user_id FROM users").fetchall()
-        conn.close()
-        for u in users:
-            user_id = u['user_id']
-            kws = news_service.list_keywords(user_id)
-            if not kws:
-                continue
-            feeds = news_service.get_feeds_for_user(user_id)
-            items = news_service.crawl_and_filter(kws, feeds=feeds)
-            for title, url in items[:5]:
-                try:
-                    line_bot_api.push_message(user_id, TextSendMessage(text=f"[News] {title}\n{url}"))
-                    news_service.record_sent(url, title)
-                except Exception:
-                    pass
+        # 每個來源只抓一次，順便更新 /web/news 的本地索引，再分送給所有訂閱者；
+        # 沒有 LINE 憑證（只跑網站）時仍要維持索引，只是不推播。
+        # 多個 worker 只讓一個跑：推播紀錄在整輪結束才寫入，同時跑會重複推播
+        with db.job_lock('news_crawler') as lk:
+            if not lk.acquired:
+                return
+            results, _stats = news_service.crawl_for_subscribers()
+            if not line_bot_api:
+                return
+            from linebot.models import TextSendMessage
+            delivered = []
+            for user_id, items in results.items():
+                for title, url in items[:5]:
+                    try:
+                        line_bot_api.push_message(user_id, TextSendMessage(text=f"[News] {title}\n{url}"))
+                        delivered.append((user_id, title, url))
+                    except Exception:
+                        pass
+            # 整輪的推播紀錄一次寫入
+            news_service.record_sent(delivered)
+
+    if not line_bot_api:
+        scheduler.start()
+        return scheduler
 
     @scheduler.scheduled_job('interval', minutes=3, id='class_reminders')
+    @db.background_job
     def remind_classes():
         from linebot.models import TextSendMessage
         now = datetime.now(tz)
-        conn = db.get_conn()
-        users = conn.execute("SELECT * FROM users").fetchall()
-        conn.close()
-        for u in users:
-            user_id = u['user_id']
-            if not u['notifications_on']:
-                continue
-            window = int(u['reminder_window'] or 15)
-            upcoming = schedule_service.find_upcoming_classes(user_id, now, within_minutes=window)
-            for cl in upcoming:
-                msg = f"提醒：{cl['course_name']} 將於 {cl['start_time']} 在 {cl.get('location') or '教室'} 上課喔！"
-                try:
-                    line_bot_api.push_message(user_id, TextSendMessage(text=msg))
-                except Exception:
-                    pass
+        reminder_service.purge_expired(now)
+        # 一次查出所有使用者即將開始的課（已套用各自的 reminder_window / notifications_on），
+        # 扣掉 ledger 中已推播過的，再搶 ledger 紀錄後才推播
+        pending = reminder_service.pending_reminders(now)
+        for cl in reminder_service.claim(pending):
+            msg = f"提醒：{cl['course_name']} 將於 {cl['start_time']} 在 {cl.get('location') or '教室'} 上課喔！"
+            try:
+                line_bot_api.push_message(cl['user_id'], TextSendMessage(text=msg))
+            except Exception:
+                reminder_service.release([cl])
 
     scheduler.start()
     return scheduler